@@ -0,0 +1,180 @@
+"""Caches processed results, such as volume backscatter, on local disk.
+
+Results are keyed by the identity of the RAW files they were computed
+from (path, size and modification time, or optionally a hash of their
+content) and by the parameters of the computation. Each entry is a
+directory of .npy files which are memory mapped on a hit, so a cached
+echogram is returned without re-parsing any RAW file. When the cache
+grows beyond its size budget the least recently used entries are
+evicted.
+
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump when the format of entries, or the results they hold, change.
+FORMAT = 1
+
+
+def default_directory():
+    """Returns the default cache directory, ~/.cache/echonix/sv.
+
+    """
+    return os.path.join(os.path.expanduser('~'), '.cache', 'echonix', 'sv')
+
+
+def file_identity(filename, content_hash=False):
+    """Returns a list identifying the file designated by filename, being
+    its absolute path, size and modification time, or with content_hash
+    its path and the SHA-1 digest of its content.
+
+    """
+    path = os.path.abspath(filename)
+    if content_hash:
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return [path, h.hexdigest()]
+    st = os.stat(filename)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def normalise(value):
+    """Returns value with NumPy scalars made Python numbers, integral
+    floats made ints and sets made sorted lists, recursively, so that
+    equal parameters give equal keys, e.g. 38000 and 38000.0.
+
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted((normalise(v) for v in value), key=repr)
+    if isinstance(value, (list, tuple)):
+        return [normalise(v) for v in value]
+    return value
+
+
+class SvCache(object):
+    """A size bounded, least recently used cache of tuples of NumPy
+    arrays and JSON serialisable values, stored in directory.
+
+    """
+
+    def __init__(self, directory=None, max_bytes=4 * 1024**3,
+                 content_hash=False):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, filenames, *parameters):
+        """Returns the key of a result computed from the given files with
+        the given JSON serialisable parameters.
+
+        """
+        identity = [FORMAT,
+                    [file_identity(f, self.content_hash) for f in filenames],
+                    normalise(list(parameters))]
+        text = json.dumps(identity, default=str)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the tuple cached under key, with arrays memory mapped
+        read only, or None if there is no such entry.
+
+        """
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'entry.json')) as f:
+                values = json.load(f)
+            result = tuple(np.load(os.path.join(entry, v['array']),
+                                   mmap_mode='r')
+                           if isinstance(v, dict) else v
+                           for v in values)
+            # The modification time of an entry records its last use
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """Caches result, a tuple of arrays and JSON serialisable values,
+        under key, then evicts entries to keep within the size budget.
+
+        """
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+
+        temporary = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            values = []
+            for i, value in enumerate(result):
+                if isinstance(value, np.ndarray):
+                    name = '{0}.npy'.format(i)
+                    np.save(os.path.join(temporary, name), value)
+                    values.append({'array': name})
+                elif isinstance(value, np.generic):
+                    values.append(value.item())
+                else:
+                    values.append(value)
+            with open(os.path.join(temporary, 'entry.json'), 'w') as f:
+                json.dump(values, f)
+            os.rename(temporary, entry)
+        except OSError:
+            shutil.rmtree(temporary, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def entries(self):
+        """Returns a list of (last used time, size in bytes, path) of each
+        entry.
+
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                pass
+        return entries
+
+    def size(self):
+        """Returns the total size in bytes of the cache.
+
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within
+        its size budget.
+
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Removes every entry.
+
+        """
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
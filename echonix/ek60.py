@@ -2,98 +2,599 @@
 
 """
 
+import os
 import math
+import threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from collections import namedtuple, OrderedDict
+from functools import partial
 import numpy as np
-from echonix import raw
+from echonix import raw, store
 
 
-def raws_to_sv_with_angles(filenames, frequency, start=None, end=None):
-    """Given a list of filenames designating EK60 RAW files, read those
-    RAW files and return an of volume backscatter whose rows represent
-    pings. The alongships angles, athwartships angles and the range in
-    metres are also returned.
+def sample_datagrams(filenames, frequency, start=None, end=None,
+                     datagram_reader=raw.read_datagram, use_index=False,
+                     config=None, offsets=None):
+    """Given a list of filenames designating EK60 RAW files, generates
+    (datagram, config) pairs for each RAW0 datagram of the given
+    frequency between the start and end filetimes, where config is the
+    CON0 datagram in effect. frequency may also be a collection of
+    frequencies, or None for all frequencies.
+
+    If use_index is True, a datagram index (see raw.load_index) is
+    used to seek straight to the wanted datagrams rather than parsing
+    every datagram in each file. If use_index is 'idx', the Simrad .idx
+    file accompanying each RAW file, if any, is used to seek to the
+    ping preceding start.
+
+    config is the CON0 datagram in effect before the first file, for
+    when the first file does not start with one.
+
+    offsets, for a single file, is a sorted array of the offsets of the
+    CON0 and RAW0 datagrams to read, as returned by index_offsets, in
+    which case the file is neither scanned nor its index loaded.
 
     """
-    config = None
-    pings = []
-    athwartships = []
-    alongships = []
-    r = None
+    if offsets is not None and len(filenames) != 1:
+        raise ValueError('offsets can only be given for a single file')
+
+    if frequency is None:
+        frequencies = None
+    elif isinstance(frequency, (set, frozenset, list, tuple)):
+        frequencies = set(frequency)
+    else:
+        frequencies = {frequency}
+
     for filename in filenames:
         with open(filename, "rb") as f:
-            while True:
-                datagram = raw.read_encapsulated_datagram(f, raw.read_datagram)
-                if not datagram:
-                    break
+            if use_index == 'idx':
+                idx = raw.idx_filename(filename)
+                if start is not None and os.path.exists(idx):
+                    pingindex = raw.load_idx(idx)
+                    i = np.searchsorted(pingindex.filetimes,
+                                        np.uint64(start)) - 1
+                    if i > 0:
+                        # Read the CON0 at the start of the file, then
+                        # skip ahead to the ping preceding start
+                        datagram = raw.read_encapsulated_datagram(
+                            f, datagram_reader)
+                        if datagram and \
+                                datagram.dgheader.datagramtype == 'CON0':
+                            config = datagram
+                        f.seek(int(pingindex.offsets[i]))
+            elif use_index or offsets is not None:
+                if offsets is None:
+                    offsets = index_offsets(raw.load_index(filename),
+                                            frequencies, start, end)
+                for offset in offsets:
+                    datagram = raw.read_datagram_at(f, int(offset),
+                                                    datagram_reader)
+                    if datagram.dgheader.datagramtype == 'CON0':
+                        config = datagram
+                    else:
+                        yield datagram, config
+                offsets = None
+                continue
+
+            for datagram in raw.iter_selected_datagrams(
+                    f, {'CON0', 'RAW0'}, frequencies=frequencies,
+                    datagram_reader=datagram_reader):
 
                 if datagram.dgheader.datagramtype == 'CON0':
                     config = datagram
-                elif datagram.dgheader.datagramtype == 'RAW0' \
-                        and datagram.frequency == frequency:
-
+                else:
                     filetime = raw.datagram_filetime(datagram)
 
                     if ((start is None) or (filetime >= start)) \
                         and ((end is None) or (filetime <= end)):
+                        yield datagram, config
+
 
-                        ping, r = datagram_volume_backscatter(datagram, config)
-                        pings.append(ping)
-                        athwartships.append(datagram.athwartship)
-                        alongships.append(datagram.alongship)
+def index_offsets(index, frequencies=None, start=None, end=None):
+    """Returns the sorted offsets of the CON0 datagrams and of the RAW0
+    datagrams of the given frequencies between the start and end
+    filetimes in a raw.DatagramIndex.
+
+    """
+    configs = raw.select_index(index, ['CON0'])
+    samples = raw.select_index(index, ['RAW0'], frequencies=frequencies,
+                               start=start, end=end)
+    return np.sort(np.concatenate((configs['offset'], samples['offset'])))
 
-    return np.array(pings, dtype=np.float64), np.array(alongships, dtype=np.float64), np.array(athwartships, dtype=np.float64), r
 
+class PingMatrix(object):
+    """Builds a 2D array whose rows represent pings, one ping at a time.
 
+    The array is preallocated for npings pings of nsamples samples if
+    those are known (e.g. from a datagram index) and otherwise grows
+    geometrically. Pings shorter than the longest, e.g. after a range
+    change, are padded with fill rather than producing an object
+    array.
+
+    """
 
+    def __init__(self, npings=None, nsamples=0, dtype=np.float64,
+                 fill=np.nan):
+        self.fill = fill
+        self.data = np.full((npings or 64, nsamples), fill, dtype=dtype)
+        self.counts = np.zeros(len(self.data), dtype=np.int64)
+        self.n = 0
+
+    def append(self, ping):
+        """Appends ping, a 1D array of samples, as the next row.
+
+        """
+        m = len(ping)
+        rows, columns = self.data.shape
+        if self.n == rows or m > columns:
+            self.grow(2 * rows if self.n == rows else rows,
+                      max(m, columns))
+        self.data[self.n, :m] = ping
+        self.counts[self.n] = m
+        self.n += 1
+
+    def grow(self, rows, columns):
+        data = np.full((rows, columns), self.fill, dtype=self.data.dtype)
+        data[:self.n, :self.data.shape[1]] = self.data[:self.n]
+        counts = np.zeros(rows, dtype=np.int64)
+        counts[:self.n] = self.counts[:self.n]
+        self.data = data
+        self.counts = counts
+
+    def result(self):
+        """Returns the array of pings and a vector of the number of samples
+        in each ping. Unused preallocated rows are released in place, so
+        the builder should not be appended to afterwards.
+
+        """
+        if self.n < len(self.data):
+            self.data.resize((self.n, self.data.shape[1]), refcheck=False)
+            self.counts.resize(self.n, refcheck=False)
+        return self.data, self.counts
+
+
+def index_ping_counts(filenames, frequencies=None, start=None, end=None):
+    """Returns a dictionary of the number of RAW0 pings of each frequency
+    (or just the given frequencies) between start and end in the given
+    RAW files, using their datagram indexes.
 
-def raws_to_sv(filenames, frequency, start=None, end=None):
+    """
+    counts = {}
+    for filename in filenames:
+        entries = raw.select_index(raw.load_index(filename), ['RAW0'],
+                                   frequencies=frequencies,
+                                   start=start, end=end)
+        for frequency, n in zip(*np.unique(entries['frequency'],
+                                           return_counts=True)):
+            frequency = float(frequency)
+            counts[frequency] = counts.get(frequency, 0) + int(n)
+    return counts
+
+
+def raws_to_sv_with_angles(filenames, frequency, start=None, end=None,
+                           use_index=False, counts=False, dtype=np.float64,
+                           angle_dtype=None, cache=None):
+    """Given a list of filenames designating EK60 RAW files, read those
+    RAW files and return an of volume backscatter whose rows represent
+    pings. The alongships angles, athwartships angles and the range in
+    metres are also returned.
+
+    Pings shorter than the longest are padded with NaN. If counts is
+    True, a vector of the number of samples in each ping is also
+    returned.
+
+    Computation and results are of the given floating point dtype,
+    e.g. np.float32 to halve memory use. The angles are of angle_dtype,
+    by default the same as dtype. If angle_dtype is np.int8 the angles
+    are returned as raw electrical angle steps of raw.ANGLE_SCALE
+    degrees, padded with 0.
+
+    If cache is an echonix.cache.SvCache, results are looked up there
+    first and stored there otherwise. Cached arrays are memory mapped
+    read only.
+
+    """
+    if cache is not None:
+        key = cache.key(filenames, 'raws_to_sv_with_angles', frequency,
+                        start, end, counts, np.dtype(dtype).str,
+                        np.dtype(angle_dtype or dtype).str)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    channels = raws_to_sv_channels(filenames, [frequency], start, end,
+                                   True, 'frequency', use_index, counts,
+                                   dtype, angle_dtype)
+    if channels:
+        result = next(iter(channels.values()))
+    else:
+        empty = np.empty((0, 0), dtype=dtype)
+        result = (empty, empty.astype(angle_dtype or dtype),
+                  empty.astype(angle_dtype or dtype), None)
+        if counts:
+            result += (np.empty(0, dtype=np.int64),)
+
+    if cache is not None:
+        cache.put(key, result)
+
+    return result
+
+
+def raws_to_sv(filenames, frequency, start=None, end=None, use_index=False,
+               counts=False, dtype=np.float64, cache=None):
     """Given a list of filenames designating EK60 RAW files, read those
     RAW files and return an array of volume backscatter whose
     rows represent pings.  The range in metres is also returned.
 
+    Pings shorter than the longest are padded with NaN. If counts is
+    True, a vector of the number of samples in each ping is also
+    returned. Computation and results are of the given floating point
+    dtype.
+
+    If cache is an echonix.cache.SvCache, results are looked up there
+    first and stored there otherwise. Cached arrays are memory mapped
+    read only.
+
     """
+    if cache is not None:
+        key = cache.key(filenames, 'raws_to_sv', frequency, start, end,
+                        counts, np.dtype(dtype).str)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+    channels = raws_to_sv_channels(filenames, [frequency], start, end,
+                                   False, 'frequency', use_index, counts,
+                                   dtype)
+    if channels:
+        result = next(iter(channels.values()))
+    else:
+        result = (np.empty((0, 0), dtype=dtype), None)
+        if counts:
+            result += (np.empty(0, dtype=np.int64),)
+
+    if cache is not None:
+        cache.put(key, result)
+
+    return result
+
+
+def raws_to_sv_channels(filenames, frequencies=None, start=None, end=None,
+                        angles=False, by='frequency', use_index=False,
+                        counts=False, dtype=np.float64, angle_dtype=None):
+    """Given a list of filenames designating EK60 RAW files, read those
+    RAW files once and return a dictionary of results for every
+    channel, or just those of the given frequencies.
+
+    The dictionary is keyed by frequency, or by channel identification
+    if by is 'channelid'. Each value is a tuple of volume backscatter
+    and range, as returned by raws_to_sv, or if angles is True of
+    volume backscatter, alongships angles, athwartships angles and
+    range, as returned by raws_to_sv_with_angles. If counts is True,
+    each tuple ends with a vector of the number of samples in each
+    ping.
+
+    The arrays are built with PingMatrix, preallocated from the datagram
+    indexes if use_index is True. The range is that of the longest
+    ping. dtype and angle_dtype are as for raws_to_sv_with_angles.
+
+    """
+    angle_dtype = np.dtype(angle_dtype or dtype)
+    steps = angle_dtype == np.int8
+
+    if use_index is True:
+        npings = index_ping_counts(filenames, frequencies, start, end)
+    else:
+        npings = {}
+
+    # Datagrams are decoded in dtype, so that Sv does not depend on
+    # angle_dtype; PingMatrix casts the angles to angle_dtype.
+    reader = partial(raw.read_datagram, angles=angles, dtype=dtype)
+    channels = {}
+    for datagram, config in sample_datagrams(filenames, frequencies, start,
+                                             end, reader, use_index):
+        if by == 'channelid':
+            transducer = config.configurationtransducer[datagram.channel-1]
+            key = transducer.channelid
+        else:
+            key = datagram.frequency
+
+        channel = channels.get(key)
+        if channel is None:
+            n = npings.get(datagram.frequency)
+            channel = {'pings': PingMatrix(n, datagram.count, dtype),
+                       'r': 0}
+            if angles:
+                fill = 0 if steps else np.nan
+                channel['alongships'] = PingMatrix(n, datagram.count,
+                                                   angle_dtype, fill)
+                channel['athwartships'] = PingMatrix(n, datagram.count,
+                                                     angle_dtype, fill)
+            channels[key] = channel
+
+        ping, r = datagram_volume_backscatter(datagram, config,
+                                              dtype=dtype)
+        channel['pings'].append(ping)
+        channel['r'] = max(channel['r'], r)
+        if steps:
+            pairs = datagram.angle.view(np.int8).reshape(-1, 2)
+            channel['alongships'].append(pairs[:, 1])
+            channel['athwartships'].append(pairs[:, 0])
+        elif angles:
+            channel['alongships'].append(datagram.alongship)
+            channel['athwartships'].append(datagram.athwartship)
+
+    result = {}
+    for key, channel in channels.items():
+        sv, n = channel['pings'].result()
+        if angles:
+            values = (sv, channel['alongships'].result()[0],
+                      channel['athwartships'].result()[0], channel['r'])
+        else:
+            values = (sv, channel['r'])
+        result[key] = values + (n,) if counts else values
+
+    return result
+
+
+def raws_to_store(filenames, frequency, path, start=None, end=None,
+                  use_index=False, chunksize=1024, dtype=np.float32):
+    """Given a list of filenames designating EK60 RAW files, read those
+    RAW files and append the volume backscatter of each ping of the
+    given frequency to the chunked on disk store at path (see
+    echonix.store), holding no more than one chunk in memory. Returns
+    the number of pings written.
+
+    """
+    reader = partial(raw.read_datagram, angles=False, dtype=dtype)
+    n = 0
+    with store.SvStoreWriter(path, chunksize, dtype,
+                             {'frequency': frequency}) as writer:
+        for datagram, config in sample_datagrams(filenames, frequency, start,
+                                                 end, reader, use_index):
+            ping, r = datagram_volume_backscatter(datagram, config,
+                                                  dtype=dtype)
+            writer.append(ping, raw.datagram_filetime(datagram), r)
+            n += 1
+    return n
+
+
+def initial_configs(filenames):
+    """Given a list of filenames designating EK60 RAW files, returns a
+    list of the CON0 datagram in effect at the start of each file, being
+    that of the file itself or else that carried over from an earlier
+    file, or None.
+
+    """
+    configs = []
     config = None
-    pings = []
-    r = None
     for filename in filenames:
         with open(filename, "rb") as f:
-            while True:
-                datagram = raw.read_encapsulated_datagram(f, raw.read_datagram)
-                if not datagram:
-                    break
+            dgheader = raw.read_encapsulated_datagram(f,
+                                                      raw.read_datagram_header)
+            if dgheader and dgheader.datagramtype == 'CON0':
+                f.seek(0)
+                config = raw.read_encapsulated_datagram(f)
+        configs.append(config)
+    return configs
+
+
+def file_to_shared_sv(filename, frequency, start, end, config, use_index,
+                      dtype, offsets=None):
+    """Computes the volume backscatter of one EK60 RAW file, or of the
+    datagrams at the given offsets of it (see sample_datagrams), given
+    the CON0
+    datagram in effect before it, into a block of shared memory.
+    Returns the name of the block (None if there are no pings), the
+    shape and dtype of the array in it, the sample counts and filetimes
+    of the pings, and the range in metres of the longest ping.
+
+    The caller is responsible for unlinking the shared memory.
 
-                if datagram.dgheader.datagramtype == 'CON0':
-                    config = datagram
-                elif datagram.dgheader.datagramtype == 'RAW0' \
-                        and datagram.frequency == frequency:
+    """
+    reader = partial(raw.read_datagram, angles=False, dtype=dtype)
+    pings = PingMatrix(dtype=dtype)
+    filetimes = []
+    r = 0
+    for datagram, config in sample_datagrams([filename], frequency, start,
+                                             end, reader, use_index, config,
+                                             offsets):
+        ping, rp = datagram_volume_backscatter(datagram, config, dtype=dtype)
+        pings.append(ping)
+        filetimes.append(raw.datagram_filetime(datagram))
+        r = max(r, rp)
+
+    sv, counts = pings.result()
+    filetimes = np.array(filetimes, dtype=np.uint64)
+    if sv.size == 0:
+        return None, sv.shape, sv.dtype.str, counts, filetimes, r
+
+    shm = shared_memory.SharedMemory(create=True, size=sv.nbytes)
+    try:
+        np.ndarray(sv.shape, sv.dtype, buffer=shm.buf)[:] = sv
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    if os.name == 'posix':
+        # Ownership passes to the caller, so stop this process's resource
+        # tracker unlinking the block when the worker exits. The tracker
+        # knows POSIX blocks by their name with a leading slash.
+        resource_tracker.unregister('/' + shm.name, 'shared_memory')
+    return shm.name, sv.shape, sv.dtype.str, counts, filetimes, r
+
+
+def unlink_shared_memory(name):
+    """Unlinks the block of shared memory with the given name.
 
-                    filetime = raw.datagram_filetime(datagram)
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
 
-                    if ((start is None) or (filetime >= start)) \
-                        and ((end is None) or (filetime <= end)):
 
-                        ping, r = datagram_volume_backscatter(datagram, config)
-                        pings.append(ping)
+def _file_to_shared_sv(args):
+    return file_to_shared_sv(*args)
 
-    return np.array(pings), r
 
+def raws_to_sv_parallel(filenames, frequency, start=None, end=None,
+                        processes=None, use_index=False, counts=False,
+                        dtype=np.float64):
+    """As raws_to_sv, but decodes and calibrates the files concurrently
+    in a pool of processes (by default one per CPU).
 
-def raw_to_sv(filename, frequency, start=None, end=None):
+    The CON0 configuration carried over from earlier files is passed to
+    each worker, workers return their pings through shared memory and
+    the pings are reassembled in time order.
+
+    """
+    configs = initial_configs(filenames)
+    jobs = [(filename, frequency, start, end, config, use_index, dtype)
+            for filename, config in zip(filenames, configs)]
+
+    return shared_sv_pool(jobs, processes, counts, dtype)
+
+
+def shared_sv_pool(jobs, processes, counts, dtype):
+    """Runs file_to_shared_sv on each of jobs, being tuples of its
+    arguments, in a pool of processes and assembles the results into
+    an array of volume backscatter whose rows are pings in time order,
+    as returned by raws_to_sv.
+
+    """
+    # Wait for every job, even after one fails, so that the blocks of
+    # those that succeeded can be unlinked
+    parts = []
+    error = None
+    with multiprocessing.Pool(processes) as pool:
+        pending = [pool.apply_async(_file_to_shared_sv, (job, ))
+                   for job in jobs]
+        for result in pending:
+            try:
+                parts.append(result.get())
+            except Exception as e:
+                error = error or e
+
+    remaining = {p[0] for p in parts if p[0] is not None}
+    try:
+        if error is not None:
+            raise error
+        return assemble_shared_sv(parts, remaining, counts, dtype)
+    finally:
+        for name in remaining:
+            unlink_shared_memory(name)
+
+
+def assemble_shared_sv(parts, remaining, counts, dtype):
+    """Assembles the results of file_to_shared_sv into an array of
+    volume backscatter as per shared_sv_pool, unlinking each block of
+    shared memory and removing its name from the set remaining.
+
+    """
+    filetimes = np.concatenate([p[4] for p in parts]) if parts else \
+        np.zeros(0, dtype=np.uint64)
+    n = len(filetimes)
+    width = max([p[1][1] for p in parts if p[0]], default=0)
+    r = max([p[5] for p in parts], default=0) if n else None
+
+    # The row of each ping in the result, in time order
+    rows = np.empty(n, dtype=np.int64)
+    rows[np.argsort(filetimes, kind='stable')] = np.arange(n)
+
+    sv = np.full((n, width), np.nan, dtype=dtype)
+    i = 0
+    for name, shape, dt, _, times, _ in parts:
+        if name is not None:
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                block = np.ndarray(shape, dt, buffer=shm.buf)
+                sv[rows[i:i+shape[0]], :shape[1]] = block
+                del block
+            finally:
+                shm.close()
+                shm.unlink()
+                remaining.discard(name)
+        i += len(times)
+
+    if counts:
+        ns = np.empty(n, dtype=np.int64)
+        if parts:
+            ns[rows] = np.concatenate([p[3] for p in parts])
+        return sv, r, ns
+    return sv, r
+
+
+def raw_to_sv_parallel(filename, frequency, start=None, end=None,
+                       processes=None, counts=False, dtype=np.float64,
+                       config=None):
+    """As raw_to_sv, but splits the pings of the file, found with its
+    datagram index (see raw.load_index), into one run per process (by
+    default one per CPU) and decodes and calibrates the runs
+    concurrently. Each worker is given the offsets of its datagrams and
+    the CON0 datagram in effect at the start of its run, and the
+    results are merged in order.
+
+    config is the CON0 datagram in effect before the file, for when the
+    file does not start with one.
+
+    """
+    # The index is loaded once here and each worker given the offsets
+    # of its datagrams, rather than every worker loading (or, where
+    # the sidecar cannot be written, rebuilding) the index itself.
+    index = raw.load_index(filename)
+    samples = raw.select_index(index, ['RAW0'], frequencies=[frequency],
+                               start=start, end=end)
+    configs = raw.select_index(index, ['CON0'])['offset']
+
+    with open(filename, "rb") as f:
+        datagrams = [raw.read_datagram_at(f, int(offset))
+                     for offset in configs]
+
+    jobs = []
+    processes = processes or multiprocessing.cpu_count()
+    nchunks = min(processes, len(samples))
+    for chunk in np.array_split(samples, nchunks) if nchunks else []:
+        lo = int(chunk['offset'][0])
+        hi = int(chunk['offset'][-1])
+        config_at = config
+        for offset, datagram in zip(configs, datagrams):
+            if offset < lo:
+                config_at = datagram
+        inside = configs[(configs > lo) & (configs < hi)]
+        offsets = np.sort(np.concatenate((chunk['offset'], inside)))
+        jobs.append((filename, frequency, start, end, config_at, False,
+                     dtype, offsets))
+
+    return shared_sv_pool(jobs, processes, counts, dtype)
+
+
+def raw_to_sv(filename, frequency, start=None, end=None, use_index=False,
+              counts=False, dtype=np.float64, cache=None):
     """Given a filename designating an EK60 RAW file, read the file and
     return an array of volume backscatter whose rows represent
     pings. The range in metres is also returned.
 
     """
-    return raws_to_sv([filename], frequency, start, end)
+    return raws_to_sv([filename], frequency, start, end, use_index, counts,
+                      dtype, cache)
 
-def raw_to_sv_with_angles(filename, frequency, start=None, end=None):
+def raw_to_sv_with_angles(filename, frequency, start=None, end=None,
+                          use_index=False, counts=False, dtype=np.float64,
+                          angle_dtype=None, cache=None):
     """Given a filename designating an EK60 RAW file, read the file and
     return an array of volume backscatter whose rows represent
     pings. The alongships angles, athwartships angles and the range in
     metres are also returned.
 
     """
-    return raws_to_sv_with_angles([filename], frequency, start, end)
+    return raws_to_sv_with_angles([filename], frequency, start, end,
+                                  use_index, counts, dtype, angle_dtype,
+                                  cache)
 
 
 def mylog10(x):
@@ -124,13 +625,53 @@ def volume_backscatter(pr, f, G, phi, cv, t, alpha, pt,
     return pr + tvg + (2 * alpha * rangeCorrected) - CSv - (2*Sac)
 
 
-def datagram_volume_backscatter(datagram, config):
-    """Given a RAW0 datagram and a CON0 datagram as ready by echonix.raw,
-    return a NumPy ndarray of volume backscatter Sv.
+def volume_backscatter_array(pr, f, G, phi, cv, t, alpha, pt,
+                             tau, Sac, rangeCorrected):
+    """A NumPy version of volume_backscatter. The arguments may be
+    arrays which are broadcast against each other, e.g. a ping of power
+    values and the corresponding ranges, or a 2D block of power values
+    whose rows are pings with per ping parameters as columns.
 
     """
+    with np.errstate(divide='ignore'):
+        tvg = np.maximum(0, 20 * np.log10(rangeCorrected))
 
-    # TODO: Clean up
+        l = cv / f  # wavelength
+
+        CSv = 10 * np.log10((pt * (10**(G/10))**2 * l**2 * cv * tau
+                             * 10**(phi/10)) / (32 * math.pi**2))
+
+    return pr + tvg + (2 * alpha * rangeCorrected) - CSv - (2*Sac)
+
+
+def corrected_range(n, dR):
+    """Returns the range in metres of n samples of thickness dR, corrected
+    as per the Echoview documentation http://bit.ly/2pqzS2D. dR may be
+    a column of per ping sample thicknesses, giving a 2D result.
+
+    """
+    s = 2 # s is the TvgRangeCorrectionOffset
+    i = np.arange(n)
+    return np.maximum(0, (i + 1) * dR - s * dR)
+
+
+# Within a file the calibration of a channel rarely changes from ping
+# to ping, so the per sample terms of the SONAR equation can be
+# computed once and reused. A Calibration holds, for a given channel,
+# its settings and a sample count, the calibration constant (CSv +
+# 2Sac), the TVG and absorption vectors and their sum with the
+# constant, so that Sv = power + offset.
+
+Calibration = namedtuple('Calibration', ['constant', 'tvg', 'absorption',
+                                         'offset', 'rangeCorrected'])
+
+
+def datagram_calibration(datagram, config, dtype=np.float64):
+    """Given a RAW0 datagram and a CON0 datagram as read by echonix.raw,
+    return the Calibration of the datagram's channel and settings, with
+    vectors of the given floating point dtype.
+
+    """
 
     # TODO: Reconsider variable names based on standard acoustics
     # nomenclature described in Simmons and MacLennan.
@@ -154,29 +695,170 @@ def datagram_volume_backscatter(datagram, config):
 
     Sac = transducer.sacorrectiontable[idx]
 
-    pr = datagram.powerdb
+    rangeCorrected = corrected_range(datagram.count, dR).astype(dtype)
+
+    with np.errstate(divide='ignore'):
+        tvg = np.maximum(0, 20 * np.log10(rangeCorrected))
+
+    absorption = np.dtype(dtype).type(2 * alpha) * rangeCorrected
+
+    l = cv / f  # wavelength
 
-    #rangeCorrected = [(x+1)*dR for x in range(len(pr))]
+    CSv = 10 * mylog10((pt * (10**(G/10))**2 * l**2 * cv * tau
+                        * 10**(phi/10)) / (32 * math.pi**2))
 
-    # See Echoview documentation http://bit.ly/2pqzS2D for information
-    # on range correction
+    constant = CSv + 2*Sac
 
-    #tvgCFac = 2
+    return Calibration(constant, tvg, absorption,
+                       tvg + absorption - np.dtype(dtype).type(constant),
+                       rangeCorrected)
 
-    #rangeCorrected = [max(0, x - tvgCFac * dR) for x in rangeCorrected]
 
-    s = 2 # s is the TvgRangeCorrectionOffset
-    rangeCorrected = [max(0, (i + 1) * dR - s * dR) for i in range(len(pr))]
+class CalibrationCache(object):
+    """A bounded, least recently used cache of Calibrations keyed by
+    channel and ping settings. It may be shared between threads.
+
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.calibrations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def calibration(self, datagram, config, dtype=np.float64):
+        """Returns the Calibration for the given RAW0 and CON0 datagrams,
+        with vectors of the given dtype, computing it if it is not
+        already cached.
+
+        """
+        transducer = config.configurationtransducer[datagram.channel-1]
+
+        # The sample interval and absorption coefficient also determine
+        # the TVG and absorption vectors, so are part of the key.
+        key = (datagram.channel, datagram.pulselength,
+               datagram.transmitpower, datagram.frequency,
+               datagram.soundvelocity, datagram.sampleinterval,
+               datagram.absorptioncoefficient, datagram.count, transducer,
+               np.dtype(dtype))
+
+        with self.lock:
+            calibration = self.calibrations.get(key)
+            if calibration is not None:
+                self.calibrations.move_to_end(key)
+                return calibration
+
+        # Computed without holding the lock, so another thread may
+        # compute the same calibration concurrently
+        calibration = datagram_calibration(datagram, config, dtype)
+        with self.lock:
+            self.calibrations[key] = calibration
+            if len(self.calibrations) > self.maxsize:
+                self.calibrations.popitem(last=False)
+
+        return calibration
+
+    def clear(self):
+        with self.lock:
+            self.calibrations.clear()
+
 
-    sv = np.zeros(len(pr))
-    #sv = [0] * len(pr)
+calibration_cache = CalibrationCache()
 
-    # TODO - Can this be vectorised?
-    
-    for i in range(len(pr)):
-        sv[i] = volume_backscatter(pr[i], f, G, phi, cv, t, alpha,
-                                   pt, tau, Sac, rangeCorrected[i])
 
-    #total_range = len(pr) * dR
-    total_range = rangeCorrected[len(pr)-1]
+def datagram_volume_backscatter(datagram, config, cache=calibration_cache,
+                                dtype=np.float64):
+    """Given a RAW0 datagram and a CON0 datagram as ready by echonix.raw,
+    return a NumPy ndarray of volume backscatter Sv of the given
+    floating point dtype.
+
+    Calibrations are taken from cache, a CalibrationCache, which is
+    shared by default. If cache is None the calibration is computed
+    afresh.
+
+    """
+    if cache is None:
+        calibration = datagram_calibration(datagram, config, dtype)
+    else:
+        calibration = cache.calibration(datagram, config, dtype)
+
+    pr = np.asarray(datagram.powerdb)
+    if pr.dtype != dtype:
+        pr = pr.astype(dtype)
+
+    sv = pr + calibration.offset
+
+    total_range = calibration.rangeCorrected[datagram.count-1]
     return sv, total_range
+
+
+def datagrams_volume_backscatter(datagrams, config, dtype=np.float64):
+    """Given a list of RAW0 datagrams of one channel and a CON0 datagram
+    as read by echonix.raw, return a 2D NumPy ndarray of volume
+    backscatter Sv whose rows represent pings, computed as one block.
+    Pings shorter than the longest are padded with NaN. The range in
+    metres of the longest ping is also returned. The result is of the
+    given floating point dtype.
+
+    """
+
+    def column(name):
+        return np.array([getattr(d, name) for d in datagrams],
+                        dtype=dtype)[:, np.newaxis]
+
+    counts = [len(d.powerdb) for d in datagrams]
+    n = max(counts)
+
+    pr = np.full((len(datagrams), n), np.nan, dtype=dtype)
+    for i, datagram in enumerate(datagrams):
+        pr[i, :counts[i]] = datagram.powerdb
+
+    transducer = config.configurationtransducer[datagrams[0].channel-1]
+
+    G = transducer.gain
+    phi = transducer.equivalentbeamangle
+
+    tau = column('pulselength')
+    Sac = np.array([transducer.sacorrectiontable[
+        transducer.pulselengthtable.index(d.pulselength)]
+                    for d in datagrams], dtype=dtype)[:, np.newaxis]
+
+    cv = column('soundvelocity')
+    t = column('sampleinterval')
+    dR = cv * t / 2
+
+    rangeCorrected = corrected_range(n, dR).astype(dtype)
+
+    G, phi = np.dtype(dtype).type(G), np.dtype(dtype).type(phi)
+
+    sv = volume_backscatter_array(pr, column('frequency'), G, phi, cv, t,
+                                  column('absorptioncoefficient'),
+                                  column('transmitpower'), tau, Sac,
+                                  rangeCorrected)
+
+    return sv, rangeCorrected[np.argmax(counts), n-1]
+
+
+def follow_sv(filename, frequency, poll_interval=0.2, timeout=None,
+              dtype=np.float64, cache=calibration_cache):
+    """Given a filename designating an EK60 RAW file that is still being
+    written, generate (filetime, sv, range) for each ping of the given
+    frequency as it is written, where sv is the ping's volume
+    backscatter and range the range in metres to its last sample.
+
+    The file is polled every poll_interval seconds as per
+    raw.follow_datagrams, stopping once it has not grown for timeout
+    seconds if timeout is not None.
+
+    """
+    config = None
+    for datagram in raw.follow_datagrams(filename,
+                                         poll_interval=poll_interval,
+                                         timeout=timeout):
+        datagramtype = datagram.dgheader.datagramtype
+        if datagramtype == 'CON0':
+            config = datagram
+        elif datagramtype == 'RAW0' and config is not None \
+                and datagram.frequency == frequency:
+            sv, r = datagram_volume_backscatter(datagram, config, cache,
+                                                dtype)
+            yield raw.datagram_filetime(datagram), sv, r
@@ -0,0 +1,493 @@
+"""Interprets EK80 data from a RAW file.
+
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from echonix import raw, ek60
+
+
+# Sample frequency of the WBT transceiver, before the filter stages
+# described by the FIL1 datagrams of a channel decimate it [Hz]
+TRANSCEIVER_SAMPLE_FREQUENCY = 1.5e6
+
+
+def channel_filters(datagrams):
+    """Given datagrams, return a dictionary mapping the channelid of each
+    FIL1 datagram among them to the list of that channel's filters in
+    stage order.
+
+    """
+    filters = {}
+    for datagram in datagrams:
+        if datagram.dgheader.datagramtype == 'FIL1':
+            filters.setdefault(datagram.channelid, {})[datagram.stage] = \
+                datagram
+    return {channelid: [stages[s] for s in sorted(stages)]
+            for channelid, stages in filters.items()}
+
+
+def transmit_signal(transmit, fs=TRANSCEIVER_SAMPLE_FREQUENCY):
+    """Return the ideal transmit signal for transmit, the raw.Parameter
+    of a ping, sampled at fs Hz and normalised to a peak amplitude of
+    1. The chirp (or tone for CW) is tapered at each end by a Hann
+    window over the fraction of the pulse given by the slope.
+
+    """
+    tau = transmit.pulseduration
+    f0, f1 = transmit.frequencystart, transmit.frequencyend
+
+    n = int(np.floor(tau * fs))
+    t = np.arange(n) / fs
+    y = np.cos(np.pi * (f1 - f0) / tau * t**2 + 2 * np.pi * f0 * t)
+
+    nw = int(np.round(tau * fs * (transmit.slope or 0) * 2))
+    w = np.hanning(nw)
+    h = min(nw // 2, n // 2)
+    taper = np.ones(n)
+    taper[:h] = w[:h]
+    taper[n - h:] = w[nw - h:]
+    y *= taper
+
+    return y / np.max(np.abs(y)) if n else y
+
+
+def filter_signal(signal, filters):
+    """Pass signal through each filter stage in turn, each being a FIL1
+    datagram, convolving with its coefficients and decimating.
+
+    """
+    y = np.asarray(signal, dtype=np.complex64)
+    for f in filters:
+        y = np.convolve(y, f.coefficients)[::f.decimationfactor]
+    return y.astype(np.complex64)
+
+
+def fft_length(n):
+    """Return the smallest length of at least n whose only prime factors
+    are 2, 3 and 5, for which FFTs are fast.
+
+    """
+    best = 1
+    while best < n:
+        best *= 2
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def replica_key(transmit, filters, fs):
+    return (transmit, fs,
+            tuple((f.stage, f.decimationfactor, f.coefficients.tobytes())
+                  for f in filters))
+
+
+class ReplicaCache(object):
+    """A bounded, least recently used cache of replicas of the transmit
+    signal, as received through the filter stages of a channel, and of
+    their spectra for the FFT lengths used. It may be shared between
+    threads.
+
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key, compute):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def replica(self, transmit, filters, fs=TRANSCEIVER_SAMPLE_FREQUENCY):
+        """Returns the replica for the given raw.Parameter and filter
+        stages, computing it if it is not already cached.
+
+        """
+        return self.lookup(replica_key(transmit, filters, fs),
+                           lambda: filter_signal(
+                               transmit_signal(transmit, fs), filters))
+
+    def spectrum(self, transmit, filters, nfft,
+                 fs=TRANSCEIVER_SAMPLE_FREQUENCY):
+        """Returns the conjugate spectrum of length nfft of the replica,
+        scaled by the replica's energy, for matched filtering.
+
+        """
+        replica = self.replica(transmit, filters, fs)
+        key = (replica_key(transmit, filters, fs), nfft)
+
+        def compute():
+            energy = np.sum(np.abs(replica)**2)
+            return (np.conj(np.fft.fft(replica, nfft)) /
+                    energy).astype(np.complex64)
+
+        return self.lookup(key, compute)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+replica_cache = ReplicaCache()
+
+
+def pulse_compress(samples, transmit, filters,
+                   fs=TRANSCEIVER_SAMPLE_FREQUENCY, cache=replica_cache):
+    """Given complex samples of one channel as a 3D array of shape
+    (pings, samples, quadrants), such as returned by raw.samples3_array,
+    return them matched filtered with the replica of the transmit
+    signal, computed with one batched FFT. Samples that are NaN (i.e.
+    padding) stay NaN.
+
+    The result is normalised by the energy of the replica, so that a
+    received copy of the replica compresses to its amplitude.
+
+    """
+    samples = np.asarray(samples, dtype=np.complex64)
+    n = samples.shape[1]
+    replica = cache.replica(transmit, filters, fs)
+
+    missing = np.isnan(samples)
+    x = np.where(missing, 0, samples)
+
+    # Correlation by FFT, long enough that it does not wrap round
+    nfft = fft_length(n + len(replica) - 1)
+    spectrum = cache.spectrum(transmit, filters, nfft, fs)
+    y = np.fft.ifft(np.fft.fft(x, nfft, axis=1) * spectrum[:, np.newaxis],
+                    axis=1)[:, :n]
+
+    y = y.astype(np.complex64, copy=False)
+    y[missing] = np.nan
+    return y
+
+
+def datagrams_pulse_compress(datagrams, transmit, filters,
+                             fs=TRANSCEIVER_SAMPLE_FREQUENCY,
+                             cache=replica_cache):
+    """Given a list of RAW3 datagrams of one channel, return their
+    complex samples pulse compressed as per pulse_compress.
+
+    """
+    return pulse_compress(raw.samples3_array(datagrams), transmit, filters,
+                          fs, cache)
+
+
+# Calibration of complex samples, as for the EK80 manual and echopype.
+# The received electrical power is computed from the mean of the
+# quadrants, which for FM pings are pulse compressed first, given the
+# impedances of the receiver and the transducer.
+
+RECEIVER_IMPEDANCE = 1000  # zer [Ohm]
+TRANSDUCER_IMPEDANCE = 75  # zet [Ohm]
+
+
+def received_power(samples, zer=RECEIVER_IMPEDANCE,
+                   zet=TRANSDUCER_IMPEDANCE):
+    """Given complex samples as a 3D array of shape (pings, samples,
+    quadrants), return the received power [W] as a 2D array of shape
+    (pings, samples).
+
+    """
+    nq = samples.shape[2]
+    y = np.mean(samples, axis=2)
+    return (nq * np.abs(y)**2 / (2 * np.sqrt(2))**2 *
+            (np.abs(zer + zet) / zer)**2 / zet)
+
+
+def francois_garrison(f, c=1500, temperature=10, salinity=35, depth=0,
+                      acidity=8):
+    """Return the absorption coefficient [dB/m] of sea water at frequency
+    f [Hz] after Francois and Garrison (1982), given the sound speed c
+    [m/s], temperature [C], salinity [PSU], depth [m] and acidity [pH].
+
+    """
+    f = f / 1000
+    t = temperature
+    k = t + 273
+
+    # Boric acid
+    a1 = 8.86 / c * 10**(0.78 * acidity - 5)
+    f1 = 2.8 * np.sqrt(salinity / 35) * 10**(4 - 1245 / k)
+
+    # Magnesium sulphate
+    a2 = 21.44 * salinity / c * (1 + 0.025 * t)
+    p2 = 1 - 1.37e-4 * depth + 6.2e-9 * depth**2
+    f2 = 8.17 * 10**(8 - 1990 / k) / (1 + 0.0018 * (salinity - 35))
+
+    # Pure water
+    if t <= 20:
+        a3 = 4.937e-4 - 2.59e-5 * t + 9.11e-7 * t**2 - 1.5e-8 * t**3
+    else:
+        a3 = 3.964e-4 - 1.146e-5 * t + 1.45e-7 * t**2 - 6.5e-10 * t**3
+    p3 = 1 - 3.83e-5 * depth + 4.9e-10 * depth**2
+
+    alpha = (a1 * f1 * f**2 / (f**2 + f1**2) +
+             a2 * p2 * f2 * f**2 / (f**2 + f2**2) +
+             a3 * p3 * f**2)
+    return alpha / 1000
+
+
+def environment_absorption(environment, f):
+    """Return the absorption coefficient [dB/m] at frequency f [Hz] for
+    the given raw.Environment.
+
+    """
+    e = environment
+    return francois_garrison(f, e.soundspeed or 1500,
+                             10 if e.temperature is None else e.temperature,
+                             35 if e.salinity is None else e.salinity,
+                             e.depth or 0,
+                             8 if e.acidity is None else e.acidity)
+
+
+def configuration_channel(configuration, channelid):
+    """Return the raw.ChannelConfiguration of channelid in the given
+    raw.Configuration, or None.
+
+    """
+    for channel in configuration.channels:
+        if channel.channelid == channelid:
+            return channel
+    return None
+
+
+def pulse_duration_value(channel, values, parameter):
+    """Return the one of values, given per CW pulse duration of a
+    raw.ChannelConfiguration, for the nearest pulse duration to that of
+    a raw.Parameter.
+
+    """
+    durations = channel.pulseduration
+    if not durations or len(durations) != len(values):
+        return values[0]
+    i = np.argmin(np.abs(np.array(durations) - parameter.pulseduration))
+    return values[i]
+
+
+def channel_gain(channel, parameter):
+    """Return the transducer gain [dB] of a raw.ChannelConfiguration for
+    the pulse duration of a raw.Parameter. FM pings use the gain of the
+    nearest CW pulse duration, the FrequencyPar tables not being read.
+
+    """
+    if not channel.gain:
+        raise ValueError('No gain for {0}'.format(channel.channelid))
+    return pulse_duration_value(channel, channel.gain, parameter)
+
+
+def channel_sacorrection(channel, parameter):
+    """Return the Sa correction [dB] of a raw.ChannelConfiguration for
+    the pulse duration of a raw.Parameter, or 0 if there is none.
+
+    """
+    if not channel.sacorrection:
+        return 0.0
+    return pulse_duration_value(channel, channel.sacorrection, parameter)
+
+
+def effective_pulse_duration(transmit, filters,
+                             fs=TRANSCEIVER_SAMPLE_FREQUENCY,
+                             cache=replica_cache):
+    """Return the effective pulse duration [s] of the replica of the
+    transmit signal.
+
+    """
+    replica = cache.replica(transmit, filters, fs)
+    power = np.abs(replica)**2
+    decimation = np.prod([f.decimationfactor for f in filters])
+    return np.sum(power) / np.max(power) * decimation / fs
+
+
+def datagrams_calibrate(datagrams, parameter, channel, environment,
+                        filters=(), ts=False,
+                        fs=TRANSCEIVER_SAMPLE_FREQUENCY, dtype=np.float64,
+                        cache=replica_cache):
+    """Given a list of RAW3 datagrams of one channel sharing the given
+    raw.Parameter, its raw.ChannelConfiguration, the raw.Environment
+    and the channel's FIL1 filters, return a 2D array of volume
+    backscatter Sv, or of target strength TS if ts is True, whose rows
+    represent pings, computed as one block. Pings shorter than the
+    longest are padded with NaN. The range in metres of the longest
+    ping is also returned.
+
+    The datagrams should all have the same number of quadrants, as the
+    quadrants missing from a ping would make its received power NaN.
+
+    The impedances of the receiver and transducer are taken from the
+    configuration, defaulting to RECEIVER_IMPEDANCE and
+    TRANSDUCER_IMPEDANCE.
+
+    """
+    if channel is None:
+        raise ValueError('No configuration for the channel')
+
+    samples = raw.samples3_array(datagrams)
+    if parameter.pulseform == 1:
+        samples = pulse_compress(samples, parameter, filters, fs, cache)
+
+    prx = received_power(samples,
+                         channel.impedance or RECEIVER_IMPEDANCE,
+                         channel.transducerimpedance or
+                         TRANSDUCER_IMPEDANCE).astype(dtype)
+    n = prx.shape[1]
+
+    c = environment.soundspeed or 1500
+    f = (parameter.frequencystart + parameter.frequencyend) / 2
+    alpha = environment_absorption(environment, f)
+    wavelength = c / f
+    pt = parameter.transmitpower
+    G = channel_gain(channel, parameter)
+
+    offsets = np.array([d.offset for d in datagrams])[:, np.newaxis]
+    dR = c * parameter.sampleinterval / 2
+    r = ((offsets + np.arange(n)) * dR).astype(dtype)
+
+    # The spreading loss is taken as 0 within 1 m, so that the samples
+    # at r = 0 are not -inf
+    spreading = np.log10(np.maximum(r, 1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if ts:
+            value = (10 * np.log10(prx) + 40 * spreading +
+                     2 * alpha * r -
+                     10 * np.log10(pt * wavelength**2 / (16 * np.pi**2)) -
+                     2 * G)
+        else:
+            # The equivalent beam angle scales with the square of the
+            # wavelength away from the nominal frequency
+            psi = channel.equivalentbeamangle + \
+                20 * np.log10(channel.frequency / f)
+            tau = effective_pulse_duration(parameter, filters, fs, cache)
+            # The Sa correction is only calibrated for CW pings
+            Sa = channel_sacorrection(channel, parameter) \
+                if parameter.pulseform == 0 else 0.0
+            value = (10 * np.log10(prx) + 20 * spreading +
+                     2 * alpha * r -
+                     10 * np.log10(pt * wavelength**2 * c /
+                                   (32 * np.pi**2)) -
+                     2 * G - 10 * np.log10(tau) - psi - 2 * Sa)
+
+    counts = np.array([d.count for d in datagrams])
+    i = np.argmax(counts)
+    total_range = float(r[i, counts[i] - 1]) if counts[i] else 0.0
+    return value.astype(dtype, copy=False), total_range
+
+
+def channel_blocks(filenames, channelid, start=None, end=None,
+                   blocksize=256):
+    """Given a list of filenames designating EK80 RAW files, generates
+    (datagrams, parameter, channel, environment, filters) for blocks of
+    up to blocksize consecutive RAW3 datagrams of channelid between the
+    start and end filetimes that share the same settings and number of
+    quadrants. Only XML0, FIL1 and the RAW3 datagrams of channelid are
+    decoded.
+
+    """
+    configuration = environment = None
+    parameters = raw.ParameterIndex()
+    filters = {}
+    block = []
+    settings = settings_key = None
+
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            datagrams = raw.iter_selected_datagrams(
+                f, {'XML0', 'FIL1', 'RAW3'}, channels={channelid})
+            for datagram in datagrams:
+                datagramtype = datagram.dgheader.datagramtype
+                if datagramtype == 'XML0':
+                    content = raw.datagram_xml(datagram)
+                    if isinstance(content, raw.Configuration):
+                        configuration = content
+                    elif isinstance(content, raw.Environment):
+                        environment = content
+                    else:
+                        parameters.add_datagram(datagram)
+                elif datagramtype == 'FIL1':
+                    if datagram.channelid == channelid:
+                        filters[datagram.stage] = datagram
+                elif datagramtype == 'RAW3' and \
+                        datagram.samples is not None:
+                    filetime = raw.datagram_filetime(datagram)
+                    if (start is not None and filetime < start) or \
+                            (end is not None and filetime > end):
+                        continue
+                    if configuration is None or environment is None:
+                        continue
+                    parameter = parameters.lookup(channelid, filetime)
+                    if parameter is None:
+                        continue
+                    channel = configuration_channel(configuration, channelid)
+                    if channel is None:
+                        raise ValueError('{0} is not in the configuration'
+                                         .format(channelid))
+                    current = (parameter, channel, environment,
+                               tuple(filters[s] for s in sorted(filters)))
+                    # Filters hold arrays, so are compared by identity
+                    key = current[:3] + tuple(id(f) for f in current[3]) + \
+                        (raw.raw3_quadrants(datagram.datatype), )
+                    if block and (key != settings_key or
+                                  len(block) == blocksize):
+                        yield (block, ) + settings
+                        block = []
+                    settings, settings_key = current, key
+                    block.append(datagram)
+
+    if block:
+        yield (block, ) + settings
+
+
+def raws_to_sv(filenames, channelid, start=None, end=None, ts=False,
+               blocksize=256, dtype=np.float64):
+    """Given a list of filenames designating EK80 RAW files, read those
+    RAW files and return an array of volume backscatter, or of target
+    strength if ts is True, whose rows represent the pings of channelid.
+    The range in metres is also returned.
+
+    Pings shorter than the longest are padded with NaN. Pings are
+    calibrated in blocks of up to blocksize pings.
+
+    """
+    pings = ek60.PingMatrix(dtype=dtype)
+    r = 0
+    for block, parameter, channel, environment, filters in channel_blocks(
+            filenames, channelid, start, end, blocksize):
+        values, total_range = datagrams_calibrate(block, parameter,
+                                                  channel, environment,
+                                                  filters, ts, dtype=dtype)
+        for datagram, ping in zip(block, values):
+            pings.append(ping[:datagram.count])
+        r = max(r, total_range)
+    return pings.result()[0], r
+
+
+def raw_to_sv(filename, channelid, start=None, end=None, ts=False,
+              blocksize=256, dtype=np.float64):
+    """Given a filename designating an EK80 RAW file, read the file and
+    return an array of volume backscatter, or target strength if ts is
+    True, whose rows represent the pings of channelid. The range in
+    metres is also returned.
+
+    """
+    return raws_to_sv([filename], channelid, start, end, ts, blocksize,
+                      dtype)
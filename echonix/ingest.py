@@ -0,0 +1,224 @@
+"""Receives datagrams broadcast over UDP by a running echosounder.
+
+Each UDP packet carries one datagram, either bare (type, time and
+body) or in the encapsulated format of RAW files. Packets are parsed
+with raw.read_datagram and published to any number of subscriptions,
+each having a bounded queue. When a subscriber falls behind the oldest
+datagrams in its queue are dropped and counted, so a slow consumer
+never holds up the receipt of packets.
+
+    ingest = Ingest()
+    transport = await ingest.serve('127.0.0.1', 10000)
+    async for filetime, sv, r in sv_pings(ingest, 38000):
+        ...
+
+"""
+
+import asyncio
+import struct
+import numpy as np
+from echonix import raw, ek60
+
+
+def parse_packet(packet, datagram_reader=raw.read_datagram):
+    """Parses a UDP packet holding one datagram, bare or encapsulated.
+
+    """
+    n = len(packet)
+    if n >= 8:
+        length, = struct.unpack_from('<i', packet, 0)
+        if length == n - 8 and \
+                struct.unpack_from('<i', packet, n - 4)[0] == length:
+            return datagram_reader(raw.BufferStream(packet[4:n - 4]), length)
+    return datagram_reader(raw.BufferStream(packet), n)
+
+
+class Subscription(object):
+    """A bounded queue of the datagrams of the given types (all types if
+    None) published by an Ingest. dropped counts the datagrams dropped
+    because the queue was full.
+
+    """
+
+    def __init__(self, maxsize=256, datagramtypes=None):
+        self.queue = asyncio.Queue(maxsize)
+        self.datagramtypes = datagramtypes
+        self.dropped = 0
+
+    def offer(self, datagram):
+        """Queues datagram without blocking, dropping the oldest queued
+        datagram if the queue is full.
+
+        """
+        if self.datagramtypes is not None and \
+                datagram.dgheader.datagramtype not in self.datagramtypes:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(datagram)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+
+class IngestProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, ingest):
+        self.ingest = ingest
+
+    def datagram_received(self, data, addr):
+        self.ingest.packet_received(data)
+
+
+class Ingest(object):
+    """Parses packets with datagram_reader and publishes the datagrams
+    to subscriptions. config is the last CON0 datagram received.
+    received counts the datagrams parsed, errors the packets that could
+    not be parsed.
+
+    """
+
+    def __init__(self, datagram_reader=raw.read_datagram):
+        self.datagram_reader = datagram_reader
+        self.subscriptions = []
+        self.config = None
+        self.received = 0
+        self.errors = 0
+
+    def subscribe(self, maxsize=256, datagramtypes=None):
+        """Returns a new Subscription to the datagrams received.
+
+        """
+        subscription = Subscription(maxsize, datagramtypes)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    def publish(self, datagram):
+        if datagram.dgheader.datagramtype == 'CON0':
+            self.config = datagram
+        for subscription in self.subscriptions:
+            subscription.offer(datagram)
+
+    def packet_received(self, packet):
+        try:
+            datagram = parse_packet(packet, self.datagram_reader)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            self.errors += 1
+            return
+        self.received += 1
+        self.publish(datagram)
+
+    async def serve(self, host='127.0.0.1', port=0):
+        """Listens for packets on the given UDP host and port, returning
+        the transport, whose close method stops listening.
+
+        """
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: IngestProtocol(self), local_addr=(host, port))
+        return transport
+
+
+# Consumers run their blocking work, calibration or writing to disk,
+# in an executor (by default the event loop's thread pool), so that
+# packets keep being received while it is done.
+
+async def sv_pings(ingest, frequency, maxsize=256, dtype=np.float64,
+                   cache=ek60.calibration_cache, executor=None):
+    """Generates (filetime, sv, range) for each ping of the given
+    frequency received by ingest, calibrated with the last CON0
+    datagram received as per ek60.datagram_volume_backscatter.
+
+    cache is an ek60.CalibrationCache, by default the shared one.
+
+    """
+    loop = asyncio.get_running_loop()
+    subscription = ingest.subscribe(maxsize, {'RAW0'})
+    try:
+        async for datagram in subscription:
+            if datagram.frequency != frequency or ingest.config is None:
+                continue
+            sv, r = await loop.run_in_executor(
+                executor, ek60.datagram_volume_backscatter, datagram,
+                ingest.config, cache, dtype)
+            yield raw.datagram_filetime(datagram), sv, r
+    finally:
+        ingest.unsubscribe(subscription)
+
+
+def write_packed_datagram(stream, datagram):
+    raw.write_datagram(stream, raw.pack_datagram(datagram))
+
+
+async def write_datagrams(ingest, stream, maxsize=1024, executor=None):
+    """Writes every datagram received by ingest to stream, a binary file,
+    in RAW file format.
+
+    """
+    loop = asyncio.get_running_loop()
+    subscription = ingest.subscribe(maxsize)
+    try:
+        async for datagram in subscription:
+            await loop.run_in_executor(executor, write_packed_datagram,
+                                       stream, datagram)
+    finally:
+        ingest.unsubscribe(subscription)
+
+
+class RollingEchogram(object):
+    """Holds the volume backscatter of the last npings pings as rows of a
+    2D array padded with NaN, for display as a scrolling echogram.
+
+    """
+
+    def __init__(self, npings, dtype=np.float64):
+        self.data = np.full((npings, 0), np.nan, dtype=dtype)
+        self.filetimes = np.zeros(npings, dtype=np.uint64)
+        self.range = 0.0
+        self.n = 0
+
+    def append(self, filetime, sv, r):
+        npings, nsamples = self.data.shape
+        if len(sv) > nsamples:
+            data = np.full((npings, len(sv)), np.nan, dtype=self.data.dtype)
+            data[:, :nsamples] = self.data
+            self.data = data
+        i = self.n % npings
+        self.data[i, :len(sv)] = sv
+        self.data[i, len(sv):] = np.nan
+        self.filetimes[i] = filetime
+        self.range = max(self.range, r)
+        self.n += 1
+
+    def result(self):
+        """Returns the pings held, oldest first, their filetimes and the
+        range in metres.
+
+        """
+        npings = len(self.filetimes)
+        if self.n <= npings:
+            rows = np.arange(self.n)
+        else:
+            rows = (np.arange(npings) + self.n) % npings
+        return self.data[rows], self.filetimes[rows], self.range
+
+
+async def fill_echogram(ingest, echogram, frequency, maxsize=256,
+                        dtype=np.float64, executor=None):
+    """Appends each ping of the given frequency received by ingest to
+    echogram, a RollingEchogram.
+
+    """
+    async for filetime, sv, r in sv_pings(ingest, frequency, maxsize, dtype,
+                                          executor=executor):
+        echogram.append(filetime, sv, r)
@@ -16,10 +16,20 @@ __version__ = '0.1'
 
 from collections import namedtuple
 
+import os
 import struct
 import math
+import mmap
+import bisect
+import functools
+import queue
+import threading
+import time
 import warnings
 import datetime
+import xml.etree.ElementTree as ET
+
+import numpy as np
 
 # Datagrams are defined in the Simrad reference manuals as structures
 # of low level C data types. Note that the documentation is, in my
@@ -74,6 +84,13 @@ def read_float(stream):
     return struct.unpack('f', stream.read(4))[0]
 
 
+def read_double(stream):
+    """Reads a 64-bit floating point (IEEE 754) from stream.
+
+    """
+    return struct.unpack('d', stream.read(8))[0]
+
+
 def read_bytes(stream, n):
     """Reads n bytes from stream.
 
@@ -94,7 +111,7 @@ def read_chars(stream, n):
     """
     # TODO - Should this really be UTF-8 with the possibility of
     # multibyte characters or ASCII?
-    return stream.read(n).decode('utf-8')
+    return str(stream.read(n), 'utf-8')
 
 
 def read_string(stream, n):
@@ -118,6 +135,101 @@ def read_shorts(stream, n):
     return struct.unpack('h'*n, stream.read(2*n))
 
 
+def read_short_array(stream, n):
+    """Reads n 16-bit signed integers from stream as a NumPy int16
+    array.
+
+    """
+    return np.frombuffer(stream.read(2*n), dtype='<i2')
+
+
+def skip_bytes(stream, n):
+    """Skips over n bytes of stream, seeking where the stream allows it
+    and reading otherwise.
+
+    """
+    if n <= 0:
+        return
+    if stream.seekable():
+        stream.seek(n, 1)
+    else:
+        stream.read(n)
+
+
+# Fixed size datagram structures are described declaratively as
+# layouts, being lists of (name, format) pairs in struct module
+# notation, e.g. ('frequency', 'f'). A count greater than one gives a
+# tuple, e.g. ('gaintable', '5f'), 's' fields are NUL padded strings
+# and spare bytes are (None, 'nx'). compile_layout turns a layout into
+# a single precompiled little endian struct.Struct, so a structure is
+# read or written with one call however many fields it has.
+
+Layout = namedtuple('Layout', ['names', 'struct', 'kinds', 'counts'])
+
+
+def compile_layout(fields):
+    """Compiles a list of (name, format) pairs into a Layout.
+
+    """
+    names = []
+    kinds = []
+    counts = []
+    fmt = '<'
+    for name, code in fields:
+        fmt += code
+        n = int(code[:-1]) if len(code) > 1 else 1
+        kind = code[-1]
+        if kind == 'x':
+            continue
+        names.append(name)
+        kinds.append(kind)
+        counts.append(1 if kind == 's' else n)
+    return Layout(tuple(names), struct.Struct(fmt), tuple(kinds),
+                  tuple(counts))
+
+
+def unpack_layout(layout, buffer, offset=0):
+    """Unpacks the fields of layout from buffer at offset, returning a
+    list of values in layout order.
+
+    """
+    values = layout.struct.unpack_from(buffer, offset)
+    result = []
+    i = 0
+    for kind, n in zip(layout.kinds, layout.counts):
+        if kind == 's':
+            result.append(str(values[i], 'utf-8').strip('\0'))
+        elif n == 1:
+            result.append(values[i])
+        else:
+            result.append(values[i:i+n])
+        i += n
+    return result
+
+
+def read_layout(stream, layout):
+    """Reads the fields of layout from stream, returning a list of
+    values in layout order.
+
+    """
+    return unpack_layout(layout, stream.read(layout.struct.size))
+
+
+def pack_layout(layout, values):
+    """Packs values, given in layout order, into bytes.
+
+    """
+    flat = []
+    for kind, n, value in zip(layout.kinds, layout.counts, values):
+        if kind == 's':
+            flat.append(value.encode('utf-8'))
+        elif n == 1:
+            flat.append(value)
+        else:
+            flat.extend(value)
+    return layout.struct.pack(*flat)
+
+
 #
 # "The DateTime structure contains a 64-bit integer value stating the
 # number of 100 nanosecond intervals since January 1, 1601. This is
@@ -222,13 +334,21 @@ header.
     dgheader = DatagramHeader(datagramtype, datetime)
 
     n = length - headerlength
-    read_bytes(stream, n)
+    skip_bytes(stream, n)
     return dgheader
 
 
-def read_datagram(stream, length):
+def read_datagram(stream, length, angles=True, compatible=False,
+                  dtype=np.float64):
     """Reads and parses a datagram of given length from stream.
 
+    The angles, compatible and dtype options are passed on to
+    read_sample_binary_datagram0 for RAW0 datagrams. Use
+    functools.partial to make a datagram_reader with other than the
+    default options, e.g.
+
+    partial(read_datagram, angles=False)
+
     """
     headerlength = 12
     datagramtype = read_chars(stream, 4)
@@ -241,19 +361,22 @@ def read_datagram(stream, length):
     if datagramtype == 'XML0':
         datagram = read_xml_datagram(stream, l, dgheader)
     elif datagramtype == 'FIL1':
-        datagram = read_binary_datagram(stream, l, dgheader)
+        datagram = read_filter_datagram(stream, dgheader)
     elif datagramtype == 'CON0':
         datagram = read_configuration_datagram(stream, dgheader)
     elif datagramtype == 'NME0':
         datagram = read_text_datagram(stream, l, dgheader)
     elif datagramtype == 'RAW0':
-        datagram = read_sample_binary_datagram0(stream, dgheader)
+        datagram = read_sample_binary_datagram0(stream, dgheader,
+                                                angles, compatible, dtype)
     elif datagramtype == 'RAW3':
-        datagram = read_sample_binary_datagram3(stream, dgheader)
+        datagram = read_sample_binary_datagram3(stream, dgheader, l)
     elif datagramtype == 'MRU0':
         datagram = read_mru_binary_datagram(stream, dgheader)
     elif datagramtype == 'TAG0':
         datagram = read_text_datagram(stream, l, dgheader)
+    elif datagramtype == 'IDX0':
+        datagram = read_index_datagram(stream, l, dgheader)
     else:
         warnings.warn("No implementation for this datagram")
         datagram = read_binary_datagram(stream, l, dgheader)
@@ -327,6 +450,245 @@ def read_xml_datagram(stream, length, dgheader):
     return XMLDatagram(dgheader, xml)
 
 
+# The Configuration, Environment and Parameter XML datagrams are parsed
+# into named tuples holding the values echonix uses. Lists of values,
+# such as gains per pulse duration, are separated by semicolons in the
+# XML and become tuples. Absent values are None.
+
+Configuration = namedtuple('Configuration', ['applicationname', 'version',
+                                             'channels'])
+
+ChannelConfiguration = namedtuple('ChannelConfiguration',
+                                  ['channelid',
+                                   'transceivertype',
+                                   'samplefrequency',  # [Hz]
+                                   'impedance',  # Transceiver [Ohm]
+                                   'pulseduration',  # CW [s]
+                                   'pulsedurationfm',  # FM [s]
+                                   'transducername',
+                                   'frequency',  # Nominal [Hz]
+                                   'frequencyminimum',  # [Hz]
+                                   'frequencymaximum',  # [Hz]
+                                   'equivalentbeamangle',  # [dB]
+                                   'gain',  # Per pulse duration [dB]
+                                   'sacorrection',  # Per pulse duration
+                                   'beamwidthalongship',  # [deg]
+                                   'beamwidthathwartship',  # [deg]
+                                   'anglesensitivityalongship',
+                                   'anglesensitivityathwartship',
+                                   'angleoffsetalongship',  # [deg]
+                                   'angleoffsetathwartship',  # [deg]
+                                   'transducerimpedance'])  # [Ohm]
+
+Environment = namedtuple('Environment', ['depth',  # [m]
+                                         'acidity',  # [pH]
+                                         'salinity',  # [PSU]
+                                         'soundspeed',  # [m/s]
+                                         'temperature',  # [C]
+                                         'latitude'])  # [deg]
+
+# pulseform is 0 for CW and 1 for FM. For CW frequencystart and
+# frequencyend are both the frequency.
+
+Parameter = namedtuple('Parameter', ['channelid',
+                                     'channelmode',
+                                     'pulseform',
+                                     'frequencystart',  # [Hz]
+                                     'frequencyend',  # [Hz]
+                                     'pulseduration',  # [s]
+                                     'slope',
+                                     'sampleinterval',  # [s]
+                                     'transmitpower'])  # [W]
+
+
+def xml_float(attrib, name, default=None):
+    """Returns the attribute name of attrib, an XML element's attributes,
+    as a float, or default if it is missing or empty.
+
+    """
+    value = attrib.get(name)
+    return default if value is None or value == '' else float(value)
+
+
+def xml_floats(attrib, name):
+    """Returns the attribute name of attrib, a list of numbers separated
+    by semicolons such as a gain per pulse duration, as a tuple of
+    floats, or None if it is missing.
+
+    """
+    value = attrib.get(name)
+    if value is None:
+        return None
+    return tuple(float(x) for x in value.split(';') if x)
+
+
+def parse_configuration(root):
+    """Returns a Configuration given the root element of a Configuration
+    XML datagram, with a ChannelConfiguration for each channel of each
+    transceiver.
+
+    """
+    header = root.find('Header')
+    h = header.attrib if header is not None else {}
+    channels = []
+    for transceiver in root.iter('Transceiver'):
+        t = transceiver.attrib
+        for channel in transceiver.iter('Channel'):
+            c = channel.attrib
+            transducer = channel.find('Transducer')
+            d = transducer.attrib if transducer is not None else {}
+            channels.append(ChannelConfiguration(
+                c.get('ChannelID'),
+                t.get('TransceiverType'),
+                xml_float(t, 'RxSampleFrequency'),
+                xml_float(t, 'Impedance'),
+                xml_floats(c, 'PulseDuration') or
+                xml_floats(c, 'PulseLength'),
+                xml_floats(c, 'PulseDurationFM'),
+                d.get('TransducerName'),
+                xml_float(d, 'Frequency'),
+                xml_float(d, 'FrequencyMinimum'),
+                xml_float(d, 'FrequencyMaximum'),
+                xml_float(d, 'EquivalentBeamAngle'),
+                xml_floats(d, 'Gain'),
+                xml_floats(d, 'SaCorrection'),
+                xml_float(d, 'BeamWidthAlongship'),
+                xml_float(d, 'BeamWidthAthwartship'),
+                xml_float(d, 'AngleSensitivityAlongship'),
+                xml_float(d, 'AngleSensitivityAthwartship'),
+                xml_float(d, 'AngleOffsetAlongship'),
+                xml_float(d, 'AngleOffsetAthwartship'),
+                xml_float(d, 'Impedance')))
+    return Configuration(h.get('ApplicationName'), h.get('Version'),
+                         tuple(channels))
+
+
+def parse_environment(root):
+    """Returns an Environment given the root element of an Environment
+    XML datagram.
+
+    """
+    a = root.attrib
+    return Environment(xml_float(a, 'Depth'), xml_float(a, 'Acidity'),
+                       xml_float(a, 'Salinity'), xml_float(a, 'SoundSpeed'),
+                       xml_float(a, 'Temperature'),
+                       xml_float(a, 'Latitude'))
+
+
+def parse_parameter(channel):
+    """Returns a Parameter given the Channel element of a Parameter or
+    InitialParameter XML datagram.
+
+    """
+    a = channel.attrib
+    # CW pings of earlier EK80 versions give Frequency and PulseLength
+    frequency = xml_float(a, 'Frequency')
+    return Parameter(a.get('ChannelID'),
+                     int(a.get('ChannelMode', 0)),
+                     int(a.get('PulseForm', 0)),
+                     xml_float(a, 'FrequencyStart', frequency),
+                     xml_float(a, 'FrequencyEnd', frequency),
+                     xml_float(a, 'PulseDuration',
+                               xml_float(a, 'PulseLength')),
+                     xml_float(a, 'Slope'),
+                     xml_float(a, 'SampleInterval'),
+                     xml_float(a, 'TransmitPower'))
+
+
+@functools.lru_cache(maxsize=256)
+def xml_element(xml):
+    """Parses the text of an XML datagram into an
+    xml.etree.ElementTree.Element, which should not be modified.
+
+    Results are memoised by text, as the same Parameter and
+    Environment datagrams are repeated throughout a file.
+
+    """
+    return ET.fromstring(xml)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_xml(xml):
+    """Parses the text of an XML datagram, returning a Configuration,
+    an Environment, a Parameter, or for InitialParameter a tuple of
+    Parameters, one per channel. Other XML datagrams are returned as
+    an xml.etree.ElementTree.Element, which should not be modified.
+
+    Results are memoised by text, as is the element tree (see
+    xml_element).
+
+    """
+    root = xml_element(xml)
+    if root.tag == 'Configuration':
+        return parse_configuration(root)
+    elif root.tag == 'Environment':
+        return parse_environment(root)
+    elif root.tag == 'Parameter':
+        return parse_parameter(root.find('Channel'))
+    elif root.tag == 'InitialParameter':
+        return tuple(parse_parameter(c) for c in root.iter('Channel'))
+    return root
+
+
+def datagram_xml(datagram):
+    """Returns the parsed content of an XMLDatagram as per parse_xml.
+
+    """
+    return parse_xml(datagram.xml)
+
+
+class ParameterIndex(object):
+    """Looks up the Parameter in effect for a channel at any filetime,
+    being the last one given at or before that time.
+
+    """
+
+    def __init__(self):
+        self.filetimes = {}
+        self.parameters = {}
+
+    def add(self, filetime, parameter):
+        filetimes = self.filetimes.setdefault(parameter.channelid, [])
+        parameters = self.parameters.setdefault(parameter.channelid, [])
+        i = bisect.bisect_right(filetimes, filetime)
+        filetimes.insert(i, filetime)
+        parameters.insert(i, parameter)
+
+    def add_datagram(self, datagram):
+        """Adds the parameters of datagram, if it is an XML0 Parameter or
+        InitialParameter datagram.
+
+        """
+        if datagram.dgheader.datagramtype != 'XML0':
+            return
+        content = datagram_xml(datagram)
+        if isinstance(content, Parameter):
+            content = (content, )
+        if isinstance(content, tuple) and \
+                all(isinstance(p, Parameter) for p in content):
+            for parameter in content:
+                self.add(datagram_filetime(datagram), parameter)
+
+    def lookup(self, channelid, filetime):
+        """Returns the Parameter of channelid in effect at filetime, or
+        None if there is none.
+
+        """
+        filetimes = self.filetimes.get(channelid, [])
+        i = bisect.bisect_right(filetimes, filetime) - 1
+        return self.parameters[channelid][i] if i >= 0 else None
+
+
+def parameter_index(datagrams):
+    """Returns a ParameterIndex of the parameters among datagrams.
+
+    """
+    index = ParameterIndex()
+    for datagram in datagrams:
+        index.add_datagram(datagram)
+    return index
+
+
 # "The MRU binary datagram contains motion sensor data at a given
 # time.."
 
@@ -335,17 +697,48 @@ MRUDatagram = namedtuple('MRUDatagram', ['dgheader', 'heave', 'roll',
                                          'pitch', 'heading'])
 
 
+MRU0_LAYOUT = compile_layout([('heave', 'f'),  # [m]
+                              ('roll', 'f'),  # [deg]
+                              ('pitch', 'f'),  # [deg]
+                              ('heading', 'f')])  # [deg]
+
+
 def read_mru_binary_datagram(stream, dgheader):
     """Creates an MRUDatagram with the given datagram header, reading
     content from the given stream.
 
     """
-    heave = read_float(stream)
-    roll = read_float(stream)
-    pitch = read_float(stream)
-    heading = read_float(stream)
+    return MRUDatagram(dgheader, *read_layout(stream, MRU0_LAYOUT))
+
+
+# EK60 index datagram, IDX0
+#
+# Simrad .idx files accompany each RAW file and consist of a CON0
+# datagram followed by one IDX0 datagram per ping, giving the ping
+# time and position and the byte offset of the ping in the RAW file.
+
+
+IndexDatagram = namedtuple('IndexDatagram', ['dgheader', 'pingnumber',
+                                             'distance', 'latitude',
+                                             'longitude', 'fileoffset'])
+
+
+IDX0_LAYOUT = compile_layout([('pingnumber', 'I'),
+                              ('distance', 'd'),  # [nmi]
+                              ('latitude', 'd'),  # [deg]
+                              ('longitude', 'd'),  # [deg]
+                              ('fileoffset', 'I')])  # [bytes]
+
+
+def read_index_datagram(stream, length, dgheader):
+    """Creates an IndexDatagram with the given datagram header, reading
+    content of length bytes from the given stream.
+
+    """
+    values = read_layout(stream, IDX0_LAYOUT)
+    skip_bytes(stream, length - IDX0_LAYOUT.struct.size)  # spare
 
-    return MRUDatagram(dgheader, heave, roll, pitch, heading)
+    return IndexDatagram(dgheader, *values)
 
 
 # The TextDatagram is used for NMEA NME0 and annotation text TAG0
@@ -372,19 +765,45 @@ def read_text_datagram(stream, length, dgheader):
 
 SampleDatagram3 = namedtuple('SampleDatagram3', ['dgheader', 'channelid',
                                                  'datatype', 'offset',
-                                                 'count', 'samples'])
+                                                 'count', 'samples',
+                                                 'power', 'angle'])
+
+
+RAW3_LAYOUT = compile_layout([('channelid', '128s'),
+                              ('datatype', 'h'),
+                              (None, '2x'),  # spare
+                              ('offset', 'i'),
+                              ('count', 'i')])
+
+# The bits of DataType say which kinds of sample follow, in this
+# order. Bits 8 to 10 give the number of complex values per sample,
+# one per transducer quadrant (or sector).
+
+RAW3_POWER = 1  # 16 bit power, as for RAW0
+RAW3_ANGLE = 2  # 2 x 8 bit angle, as for RAW0
+RAW3_COMPLEXFLOAT16 = 4
+RAW3_COMPLEXFLOAT32 = 8
+
+
+def raw3_quadrants(datatype):
+    """Returns the number of complex values per sample of a RAW3
+    datagram of the given datatype.
+
+    """
+    return (datatype >> 8) & 7
 
 
-def read_sample_binary_datagram3(stream, dgheader):
+def read_sample_binary_datagram3(stream, dgheader, length=None):
     """Creates a SampleDatagram3 (an EK80 RAW3 sample) with the given
     datagram header, reading content from the given stream.
 
+    Complex samples are returned as a complex64 NumPy array of shape
+    (count, quadrants), a view of the data read for ComplexFloat32
+    samples. Power and angle samples are returned as int16 arrays as
+    for RAW0. Kinds of sample not present are None.
+
     """
-    channelid = read_string(stream, 128)
-    datatype = read_short(stream)
-    read_chars(stream, 2)  # spare
-    offset = read_long(stream)
-    count = read_long(stream)
+    channelid, datatype, offset, count = read_layout(stream, RAW3_LAYOUT)
 
     # The number of values in Samples[] depends on the value of Count
     # and the Datatype.  As an example a DataType decimal value of
@@ -392,13 +811,88 @@ def read_sample_binary_datagram3(stream, dgheader):
     # that each sample consists of 4 complex numbers (one from each of
     # the 4 transducer quadrants).
 
-    if datatype == 1032:
-        samples = read_bytes(stream, 4 * 2 * count * 4)
-    else:
+    samples = power = angle = None
+
+    # The layout of samples with unknown bits set is unknown, so none
+    # of them are decoded
+    if datatype & ~0x70f or not datatype & 0xf:
         warnings.warn('Datatype {0} not yet implemented'.format(datatype))
+        if length is not None:
+            skip_bytes(stream, length - RAW3_LAYOUT.struct.size)
+        return SampleDatagram3(dgheader, channelid, datatype,
+                               offset, count, samples, power, angle)
+
+    if datatype & RAW3_POWER:
+        power = read_short_array(stream, count)
+    if datatype & RAW3_ANGLE:
+        angle = read_short_array(stream, count)
+
+    quadrants = raw3_quadrants(datatype)
+    if datatype & RAW3_COMPLEXFLOAT32:
+        samples = np.frombuffer(read_bytes(stream, 8 * count * quadrants),
+                                dtype='<c8').reshape(count, quadrants)
+    elif datatype & RAW3_COMPLEXFLOAT16:
+        # NumPy has no complex float16, so these are widened
+        values = np.frombuffer(read_bytes(stream, 4 * count * quadrants),
+                               dtype='<f2').astype(np.float32)
+        samples = values.view(np.complex64).reshape(count, quadrants)
 
     return SampleDatagram3(dgheader, channelid, datatype,
-                           offset, count, samples)
+                           offset, count, samples, power, angle)
+
+
+def samples3_array(datagrams, quadrants=None):
+    """Given a list of RAW3 datagrams, returns their complex samples as a
+    3D complex64 array of shape (pings, samples, quadrants), padded
+    with NaN where pings have fewer samples or quadrants than others.
+    quadrants defaults to the most of any of the datagrams.
+
+    """
+    counts = [d.count if d.samples is not None else 0 for d in datagrams]
+    if quadrants is None:
+        quadrants = max([d.samples.shape[1] for d in datagrams
+                         if d.samples is not None], default=0)
+    result = np.full((len(datagrams), max(counts, default=0), quadrants),
+                     np.nan, dtype=np.complex64)
+    for i, d in enumerate(datagrams):
+        if d.samples is not None:
+            q = min(quadrants, d.samples.shape[1])
+            result[i, :counts[i], :q] = d.samples[:, :q]
+    return result
+
+
+# EK80 filter binary datagram, FIL1
+#
+# The filter datagram gives the coefficients of one stage of the
+# filtering and decimation applied by the transceiver to the samples of
+# a channel, as needed to reproduce the transmit signal for pulse
+# compression.
+
+FilterDatagram = namedtuple('FilterDatagram', ['dgheader', 'stage',
+                                               'channelid',
+                                               'ncoefficients',
+                                               'decimationfactor',
+                                               'coefficients'])
+
+
+FIL1_LAYOUT = compile_layout([('stage', 'h'),
+                              (None, '2x'),  # spare
+                              ('channelid', '128s'),
+                              ('ncoefficients', 'h'),
+                              ('decimationfactor', 'h')])
+
+
+def read_filter_datagram(stream, dgheader):
+    """Creates a FilterDatagram (an EK80 FIL1 filter) with the given
+    datagram header, reading content from the given stream. The
+    coefficients are a complex64 NumPy array.
+
+    """
+    fields = read_layout(stream, FIL1_LAYOUT)
+    ncoefficients = fields[2]
+    coefficients = np.frombuffer(read_bytes(stream, 8 * ncoefficients),
+                                 dtype='<c8')
+    return FilterDatagram(dgheader, *fields, coefficients)
 
 
 # EK60 sample binary datagram, RAW0 The sample datagram contains
@@ -439,49 +933,81 @@ def twos_complement(x):
         return (x & 0x7f)
 
 
-def read_sample_binary_datagram0(stream, dgheader):
+# Power is stored in a compressed format, being 10 * log10(2) / 256
+# dB per step. Each angle sample is a pair of signed bytes, being 180
+# / 128 electrical degrees per step.
+
+POWER_SCALE = 10 * math.log10(2) / 256
+ANGLE_SCALE = 180 / 128
+
+RAW0_LAYOUT = compile_layout([('channel', 'h'),  # Channel number
+                              ('mode', 'h'),  # Datatype
+                              ('transducerdepth', 'f'),  # [m]
+                              ('frequency', 'f'),  # [Hz]
+                              ('transmitpower', 'f'),  # [W]
+                              ('pulselength', 'f'),  # [s]
+                              ('bandwidth', 'f'),  # [Hz]
+                              ('sampleinterval', 'f'),  # [s]
+                              ('soundvelocity', 'f'),  # [m/s]
+                              ('absorptioncoefficient', 'f'),  # [dB/m]
+                              ('heave', 'f'),  # [m]
+                              ('txroll', 'f'),  # [deg]
+                              ('txpitch', 'f'),  # [deg]
+                              ('temperature', 'f'),  # [C]
+                              (None, '4x'),  # spare
+                              ('rxroll', 'f'),  # [Deg]
+                              ('rxpitch', 'f'),  # [Deg]
+                              ('offset', 'i'),  # First sample
+                              ('count', 'i')])  # Number of samples
+
+
+def read_sample_binary_datagram0(stream, dgheader, angles=True,
+                                 compatible=False, dtype=np.float64):
     """Creates a SampleDatagram0 (an EK60 RAW0 sample) with the given
     datagram header, reading content from the given stream.
 
+    Power and angle samples are returned as NumPy arrays; power and
+    angle are int16, powerdb, alongship and athwartship are of the
+    given floating point dtype, float64 by default.
+
+    If angles is False the angle bytes are skipped without being
+    decoded and angle, alongship and athwartship are None.
+
+    If compatible is True, power and angle are returned as tuples and
+    powerdb, alongship and athwartship as lists, as in earlier
+    versions of echonix.
+
     """
 
     # TODO: Find some test data with Mode = 0
 
-    channel = read_short(stream)  # Channel number
-    mode = read_short(stream)  # Datatype
-    transducerdepth = read_float(stream)  # [m]
-    frequency = read_float(stream)  # [Hz]
-    transmitpower = read_float(stream)  # [W]
-    pulselength = read_float(stream)  # [s]
-    bandwidth = read_float(stream)  # [Hz]
-    sampleinterval = read_float(stream)  # [s]
-    soundvelocity = read_float(stream)  # [m/s]
-    absorptioncoefficient = read_float(stream)  # [dB/m]
-    heave = read_float(stream)  # [m]
-    txroll = read_float(stream)  # [deg]
-    txpitch = read_float(stream)  # [deg]
-    temperature = read_float(stream)  # [C]
-    read_short(stream)  # spare
-    read_short(stream)  # spare
-    rxroll = read_float(stream)  # [Deg]
-    rxpitch = read_float(stream)  # [Deg]
-    offset = read_long(stream)  # First sample
-    count = read_long(stream)  # Number of samples
-    power = read_shorts(stream, count)  # Compressed format - See Remark 1!
-    c = (10 * math.log10(2) / 256)
-    powerdb = [x * c for x in power]
-    angle = read_shorts(stream, count)  # See Remark 2 below!
-    c = 180 /128
-
-    athwartship  = [twos_complement(x & 0xff) * c for x in angle]
-    alongship  = [twos_complement((x & 0xff00) >>8) * c for x in angle]
-
-    return SampleDatagram0(dgheader, channel, mode, transducerdepth,
-                           frequency, transmitpower, pulselength, bandwidth,
-                           sampleinterval, soundvelocity,
-                           absorptioncoefficient, heave, txroll, txpitch,
-                           temperature, rxroll, rxpitch, offset, count,
-                           power, powerdb, angle, alongship, athwartship)
+    fields = read_layout(stream, RAW0_LAYOUT)
+    count = fields[-1]
+
+    power = read_short_array(stream, count)  # Compressed - See Remark 1!
+    dtype = np.dtype(dtype).type
+    powerdb = power * dtype(POWER_SCALE)
+
+    if angles:
+        angle = read_short_array(stream, count)  # See Remark 2 below!
+        # The low byte is athwartship, the high byte alongship
+        pairs = angle.view(np.int8).reshape(-1, 2)
+        athwartship = pairs[:, 0] * dtype(ANGLE_SCALE)
+        alongship = pairs[:, 1] * dtype(ANGLE_SCALE)
+    else:
+        skip_bytes(stream, 2 * count)
+        angle = alongship = athwartship = None
+
+    if compatible:
+        power = tuple(power.tolist())
+        powerdb = powerdb.tolist()
+        if angles:
+            angle = tuple(angle.tolist())
+            athwartship = athwartship.tolist()
+            alongship = alongship.tolist()
+
+    return SampleDatagram0(dgheader, *fields, power, powerdb, angle,
+                           alongship, athwartship)
 
 
 # An EK60 configuration datagram consists of a ConfigurationHeader and
@@ -523,19 +1049,21 @@ ConfigurationHeader = namedtuple('ConfigurationHeader',
                                   'transducercount'])
 
 
+CONFIGURATION_HEADER_LAYOUT = compile_layout([
+    ('surveyname', '128s'),  # "Loch Ness"
+    ('transectname', '128s'),
+    ('soundername', '128s'),  # "ER60"
+    ('version', '30s'),
+    (None, '98x'),  # spare
+    ('transducercount', 'i')])  # 1 to 7
+
+
 def read_configuration_header(stream):
     """Reads a ConfigurationHeader structure from the given stream.
 
     """
-    surveyname = read_string(stream, 128)  # "Loch Ness"
-    transectname = read_string(stream, 128)
-    soundername = read_string(stream, 128)  # "ER60"
-    version = read_string(stream, 30)
-    read_bytes(stream, 98)  # spare
-    transducercount = read_long(stream)  # 1 to 7
-
-    return ConfigurationHeader(surveyname, transectname,
-                               soundername, version, transducercount)
+    return ConfigurationHeader(*read_layout(stream,
+                                            CONFIGURATION_HEADER_LAYOUT))
 
 
 # A ConfigurationTransducer structure is a component of an EK60
@@ -566,54 +1094,46 @@ ConfigurationTransducer = namedtuple('ConfigurationTransducer',
                                       'gptsoftwareversion'])
 
 
+CONFIGURATION_TRANSDUCER_LAYOUT = compile_layout([
+    ('channelid', '128s'),  # Channel identification
+    ('beamtype', 'i'),  # 0 = Single, 1 = Split
+    ('frequency', 'f'),  # [Hz]
+    ('gain', 'f'),  # [dB] - See note below
+    ('equivalentbeamangle', 'f'),  # [dB]
+    ('beamwidthalongship', 'f'),  # [degree]
+    ('beamwidthathwartship', 'f'),  # [degree]
+    ('anglesensitibityalongship', 'f'),
+    ('anglesensitivityathwartship', 'f'),
+    ('angleoffsetalongship', 'f'),  # [degree]
+    ('angleoffsetathwartship', 'f'),  # [degree]
+    ('posx', 'f'),  # future use
+    ('posy', 'f'),  # future use
+    ('posz', 'f'),  # future use
+    ('dirx', 'f'),  # future use
+    ('diry', 'f'),  # future use
+    ('dirz', 'f'),  # future use
+    # Available pulse lengths for the channel [s]
+    ('pulselengthtable', '5f'),
+    (None, '8x'),  # future use
+    # Gain for each pulse length in the PulseLengthTable [dB]
+    ('gaintable', '5f'),
+    (None, '8x'),  # future use
+    # Sa correction for each pulse length in the PulseLengthTable [dB]
+    ('sacorrectiontable', '5f'),
+    (None, '8x'),  # spare
+    ('gptsoftwareversion', '16s'),
+    (None, '28x')])  # spare
+
+
 def read_configuration_transducer(stream):
     """Reads a ConfigurationTransducer structure from the given stream.
 
     """
-    channelid = read_string(stream, 128)  # Channel identification
-    beamtype = read_long(stream)  # 0 = Single, 1 = Split
-    frequency = read_float(stream)  # [Hz]
-    gain = read_float(stream)  # [dB] - See note below
-    equivalentbeamangle = read_float(stream)  # [dB]
-    beamwidthalongship = read_float(stream)  # [degree]
-    beamwidthathwartship = read_float(stream)  # [degree]
-    anglesensitivityalongship = read_float(stream)
-    anglesensitivityathwartship = read_float(stream)
-    angleoffsetalongship = read_float(stream)  # [degree]
-    angleoffsetathwartship = read_float(stream)  # [degree]
-    posx = read_float(stream)  # future use
-    posy = read_float(stream)  # future use
-    posz = read_float(stream)  # future use
-    dirx = read_float(stream)  # future use
-    diry = read_float(stream)  # future use
-    dirz = read_float(stream)  # future use
+    return ConfigurationTransducer(*read_layout(
+        stream, CONFIGURATION_TRANSDUCER_LAYOUT))
 
-    # Available pulse lengths for the channel [s]
-    pulselengthtable = read_floats(stream, 5)
-    read_chars(stream, 8)  # future use
-    # Gain for each pulse length in the PulseLengthTable [dB]
-    gaintable = read_floats(stream, 5)
-    read_chars(stream, 8)  # future use
-    # Sa correction for each pulse length in the PulseLengthTable [dB]
-    sacorrectiontable = read_floats(stream, 5)
-    read_chars(stream, 8)  # spare
-    gptsoftwareversion = read_string(stream, 16)
-    read_chars(stream, 28)  # spare
-
-    return ConfigurationTransducer(channelid, beamtype, frequency, gain,
-                                   equivalentbeamangle, beamwidthalongship,
-                                   beamwidthathwartship,
-                                   anglesensitivityalongship,
-                                   anglesensitivityathwartship,
-                                   angleoffsetalongship,
-                                   angleoffsetathwartship, posx, posy, posz,
-                                   dirx, diry, dirz, pulselengthtable,
-                                   gaintable,
-                                   sacorrectiontable,
-                                   gptsoftwareversion)
-
-
-def load_raw(filename, datagram_reader=read_datagram):
+
+def load_raw(filename, datagram_reader=read_datagram, use_mmap=False):
     """Loads all the datagrams from the file designated by filename.
 
     A datagram_reader can optionally be specified, being a function
@@ -622,11 +1142,18 @@ def load_raw(filename, datagram_reader=read_datagram):
     to be overriden for example to skip specific datagrams or
     customise parsing.
 
+    If use_mmap is True the file is memory mapped and sample arrays
+    are views into the mapping rather than copies (see
+    iter_raw_mmap).
+
     """
 
     # TODO: The spec requires us to check endianness by comparing
     # length fields, but in practice, everyone is using PC/Windows
 
+    if use_mmap:
+        return list(iter_raw_mmap(filename, datagram_reader))
+
     datagrams = []
 
     with open(filename, "rb") as f:
@@ -640,6 +1167,84 @@ def load_raw(filename, datagram_reader=read_datagram):
     return datagrams
 
 
+# Memory mapped reading. A BufferStream behaves like a read only
+# binary file, but read() returns memoryview slices of the underlying
+# buffer, so the existing datagram readers parse a memory mapped file
+# in place. NumPy sample arrays created with frombuffer are then views
+# into the mapping and the operating system pages in only what is
+# touched.
+
+
+class BufferStream(object):
+    """A read only, seekable binary stream over a buffer such as an
+    mmap, whose read method returns zero-copy memoryview slices.
+
+    """
+
+    def __init__(self, buffer, position=0):
+        self.buffer = memoryview(buffer).cast('B')
+        self.position = position
+
+    def read(self, n=-1):
+        start = self.position
+        if n is None or n < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + n, len(self.buffer))
+        self.position = max(start, end)
+        return self.buffer[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = len(self.buffer) + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+
+def open_raw_mmap(filename):
+    """Memory maps the file designated by filename read only, returning
+    a BufferStream positioned at the start of the file.
+
+    The mapping stays alive for as long as the stream or any view of it
+    (for example a sample array) is referenced.
+
+    """
+    with open(filename, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return BufferStream(b'')
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return BufferStream(m)
+
+
+def iter_raw_mmap(filename, datagram_reader=read_datagram):
+    """Generates the datagrams of the file designated by filename,
+    reading them in place from a memory mapping of the file.
+
+    Sample payloads (e.g. power and angle of RAW0, bytes of a
+    BinaryDatagram) are memoryview or read only NumPy views into the
+    mapping, not copies.
+
+    """
+    stream = open_raw_mmap(filename)
+    while True:
+        datagram = read_encapsulated_datagram(stream, datagram_reader)
+        if not datagram:
+            break
+        yield datagram
+
+
 # A standard encapsulation scheme is used for all data files. Each
 # datagram is preceded by a 4 byte length tag stating the datagram
 # length in bytes. An identical length tag is appended at the end of
@@ -667,6 +1272,327 @@ def read_encapsulated_datagram(stream, datagram_reader=read_datagram):
     return datagram
 
 
+# Block buffered reading. Rather than several small reads per
+# datagram, the stream is read in large blocks into a reusable buffer
+# and datagrams are parsed from there. A datagram straddling a block
+# boundary is carried over to the start of the buffer, which grows if
+# a datagram is larger than a block. Only forward reads are used, so
+# pipes and standard input work too.
+
+DEFAULT_BLOCKSIZE = 16 * 1024 * 1024
+
+
+def iter_datagrams(source, datagram_reader=read_datagram,
+                   blocksize=DEFAULT_BLOCKSIZE, readahead=0, stats=None):
+    """Generates the encapsulated datagrams read from source, being a
+    filename or a binary stream such as sys.stdin.buffer, parsing each
+    with datagram_reader as per read_encapsulated_datagram.
+
+    The stream is read blocksize bytes at a time. A truncated datagram
+    at the end of the stream is ignored with a warning.
+
+    If readahead is greater than zero, up to that many blocks are read
+    ahead in a background thread while datagrams are parsed (see
+    PrefetchReader, which can also be passed as source). If stats is a
+    dictionary, it is updated with the reader's statistics (see
+    PrefetchReader.stats) when iteration ends.
+
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, "rb", buffering=0) as f:
+            yield from iter_datagrams(f, datagram_reader, blocksize,
+                                      readahead, stats)
+        return
+
+    if readahead > 0:
+        with PrefetchReader(source, blocksize, readahead) as reader:
+            try:
+                yield from iter_datagrams(reader, datagram_reader,
+                                          blocksize)
+            finally:
+                if stats is not None:
+                    stats.update(reader.stats())
+        return
+
+    buffer = bytearray(blocksize)
+    view = memoryview(buffer)
+    start = 0
+    end = 0
+
+    while True:
+        while end - start >= 4:
+            length, = struct.unpack_from('<i', buffer, start)
+            if end - start < length + 8:
+                break
+            length2, = struct.unpack_from('<i', buffer, start + 4 + length)
+            if length != length2:
+                raise ValueError('Invalid datagram')
+            # Copy the datagram out as the buffer is about to be reused
+            body = bytes(view[start + 4:start + 4 + length])
+            start += length + 8
+            yield datagram_reader(BufferStream(body), length)
+
+        remaining = end - start
+        if start > 0:
+            buffer[:remaining] = buffer[start:end]
+            start = 0
+            end = remaining
+
+        if end >= 4:
+            needed = struct.unpack_from('<i', buffer, 0)[0] + 8
+            if needed > len(buffer):
+                view.release()
+                buffer.extend(bytes(needed - len(buffer)))
+                view = memoryview(buffer)
+
+        if hasattr(source, 'readinto'):
+            n = source.readinto(view[end:])
+        else:
+            data = source.read(len(buffer) - end)
+            n = len(data)
+            view[end:end + n] = data
+
+        if not n:
+            if end > 0:
+                warnings.warn('Truncated datagram at end of stream')
+            return
+
+        end += n
+
+
+def follow_datagrams(filename, datagram_reader=read_datagram,
+                     poll_interval=0.2, timeout=None, offset=0,
+                     blocksize=DEFAULT_BLOCKSIZE):
+    """Generates the datagrams of the RAW file designated by filename,
+    starting at offset, while it is still being written, parsing each
+    with datagram_reader.
+
+    The file is polled for new data every poll_interval seconds. Only
+    complete datagrams are parsed; a partially written datagram at the
+    end of the file is kept until the rest of it has been written. If
+    timeout is not None, generation stops once the file has not grown
+    for timeout seconds.
+
+    The file is read at most blocksize bytes at a time, so following a
+    large file from its start does not read all of it into memory.
+
+    """
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        pending = bytearray()
+        grown = time.monotonic()
+
+        while True:
+            data = f.read(blocksize)
+            if data:
+                pending += data
+                grown = time.monotonic()
+
+            start = 0
+            while len(pending) - start >= 4:
+                length, = struct.unpack_from('<i', pending, start)
+                if len(pending) - start < length + 8:
+                    break
+                length2, = struct.unpack_from('<i', pending,
+                                              start + 4 + length)
+                if length != length2:
+                    raise ValueError('Invalid datagram')
+                body = bytes(pending[start + 4:start + 4 + length])
+                start += length + 8
+                yield datagram_reader(BufferStream(body), length)
+            del pending[:start]
+
+            if not data:
+                if timeout is not None and \
+                        time.monotonic() - grown >= timeout:
+                    return
+                time.sleep(poll_interval)
+
+
+class PrefetchReader(object):
+    """A read only, forward only binary stream that reads blocks of
+    blocksize bytes from stream in a background thread, keeping up to
+    depth blocks ready, so that I/O overlaps with parsing.
+
+    wait_time is the time in seconds spent waiting for blocks that were
+    not ready, read_time the time spent reading by the background
+    thread; nblocks and nbytes count what has been read. stats returns
+    all four as a dictionary.
+
+    """
+
+    def __init__(self, stream, blocksize=DEFAULT_BLOCKSIZE, depth=2):
+        self.stream = stream
+        self.blocksize = blocksize
+        self.blocks = queue.Queue(maxsize=depth)
+        self.block = b''
+        self.position = 0
+        self.eof = False
+        self.wait_time = 0.0
+        self.read_time = 0.0
+        self.nblocks = 0
+        self.nbytes = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+        self.thread.start()
+
+    def prefetch(self):
+        try:
+            while not self.stopped.is_set():
+                t = time.perf_counter()
+                block = self.stream.read(self.blocksize)
+                self.read_time += time.perf_counter() - t
+                self.put(block)
+                if not block:
+                    return
+                self.nblocks += 1
+                self.nbytes += len(block)
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next_block(self):
+        if self.eof:
+            return False
+        try:
+            block = self.blocks.get_nowait()
+        except queue.Empty:
+            t = time.perf_counter()
+            block = self.blocks.get()
+            self.wait_time += time.perf_counter() - t
+        if isinstance(block, Exception):
+            self.eof = True
+            raise block
+        if not block:
+            self.eof = True
+            return False
+        self.block = block
+        self.position = 0
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self.position >= len(self.block) and not self.next_block():
+            return 0
+        n = min(len(view), len(self.block) - self.position)
+        view[:n] = self.block[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def read(self, n=-1):
+        chunks = []
+        while n is None or n < 0 or n > 0:
+            if self.position >= len(self.block) and not self.next_block():
+                break
+            end = len(self.block) if n is None or n < 0 else \
+                min(len(self.block), self.position + n)
+            chunks.append(self.block[self.position:end])
+            if n is not None and n >= 0:
+                n -= end - self.position
+            self.position = end
+        return b''.join(chunks)
+
+    def seekable(self):
+        return False
+
+    def readable(self):
+        return True
+
+    def stats(self):
+        """Returns a dictionary of the reader's statistics.
+
+        """
+        return {'wait_time': self.wait_time, 'read_time': self.read_time,
+                'blocks': self.nblocks, 'bytes': self.nbytes}
+
+    def close(self):
+        """Stops the background thread. The underlying stream is not
+        closed.
+
+        """
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_selected_datagrams(stream, datagramtypes, channels=None,
+                            frequencies=None,
+                            datagram_reader=read_datagram):
+    """Generates only the encapsulated datagrams in stream whose type is
+    in datagramtypes, e.g. {'NME0'}, parsing them with datagram_reader.
+
+    RAW0 and RAW3 datagrams can be further restricted to collections
+    of channels (RAW0 channel numbers or RAW3 channel identifications)
+    and RAW0 frequencies. The bodies of unwanted datagrams are skipped
+    by seeking, or by reading if the stream is not seekable, without
+    being decoded.
+
+    """
+    seekable = stream.seekable()
+
+    while True:
+        length = safe_read_long(stream)
+        if length is None:
+            return
+
+        datagramtype = read_bytes(stream, 4)
+        if len(datagramtype) < 4:
+            return
+        datagramtype = str(datagramtype, 'utf-8')
+        head = 4
+
+        wanted = datagramtype in datagramtypes
+
+        if wanted and (channels is not None or frequencies is not None):
+            if datagramtype == 'RAW0':
+                prefix = read_bytes(stream, 20)
+                head += len(prefix)
+                channel, = struct.unpack_from('<h', prefix, 8)
+                frequency, = struct.unpack_from('<f', prefix, 16)
+                wanted = ((channels is None or channel in channels)
+                          and (frequencies is None
+                               or frequency in frequencies))
+            elif datagramtype == 'RAW3':
+                prefix = read_bytes(stream, 136)
+                head += len(prefix)
+                channelid = str(prefix[8:136], 'utf-8').strip('\0')
+                wanted = channels is None or channelid in channels
+
+        if wanted:
+            if seekable:
+                stream.seek(-head, 1)
+                datagram = datagram_reader(stream, length)
+            else:
+                rest = read_bytes(stream, length - head)
+                body = BufferStream(datagramtype.encode() +
+                                    (prefix if head > 4 else b'') + rest)
+                datagram = datagram_reader(body, length)
+        else:
+            skip_bytes(stream, length - head)
+
+        length2 = safe_read_long(stream)
+        if length2 is None:
+            return
+
+        if length != length2:
+            raise ValueError('Invalid datagram')
+
+        if wanted:
+            yield datagram
+
+
 def write_datagram(stream, bytes):
     """Writes a datagram consisting of the given bytes to stream in
     encapsulated datagram format, calculating the required length
@@ -678,3 +1604,452 @@ def write_datagram(stream, bytes):
     write_long(stream, length)
     write_bytes(stream, bytes)
     write_long(stream, length)
+
+
+def pack_dgheader(dgheader):
+    """Packs a DatagramHeader into bytes.
+
+    """
+    return (dgheader.datagramtype.encode('utf-8') +
+            struct.pack('<II', *dgheader.datetime))
+
+
+def pack_datagram(datagram):
+    """Packs a datagram, as returned by read_datagram, into bytes
+    suitable for write_datagram, using the same layouts that are used
+    for reading.
+
+    The result is equivalent to the datagram as read, but not always
+    byte for byte: trailing NUL padding of text and XML datagrams is
+    not kept and the spare bytes of IDX0 datagrams are written as zero.
+
+    """
+    datagramtype = datagram.dgheader.datagramtype
+    dgheader = pack_dgheader(datagram.dgheader)
+
+    if isinstance(datagram, BinaryDatagram):
+        body = bytes(datagram.bytes)
+    elif datagramtype == 'XML0':
+        body = datagram.xml.encode('utf-8')
+    elif datagramtype in ('NME0', 'TAG0'):
+        body = datagram.text.encode('utf-8')
+    elif datagramtype == 'CON0':
+        body = pack_layout(CONFIGURATION_HEADER_LAYOUT,
+                           datagram.configurationheader)
+        for transducer in datagram.configurationtransducer:
+            body += pack_layout(CONFIGURATION_TRANSDUCER_LAYOUT, transducer)
+    elif datagramtype == 'MRU0':
+        body = pack_layout(MRU0_LAYOUT, datagram[1:])
+    elif datagramtype == 'FIL1':
+        n = len(FIL1_LAYOUT.names)
+        body = (pack_layout(FIL1_LAYOUT, datagram[1:n+1]) +
+                np.asarray(datagram.coefficients, dtype='<c8').tobytes())
+    elif datagramtype == 'IDX0':
+        body = pack_layout(IDX0_LAYOUT, datagram[1:]) + bytes(4)
+    elif datagramtype == 'RAW0':
+        if datagram.angle is None:
+            raise ValueError('RAW0 datagram was read without angles')
+        n = len(RAW0_LAYOUT.names)
+        body = (pack_layout(RAW0_LAYOUT, datagram[1:n+1]) +
+                np.asarray(datagram.power, dtype='<i2').tobytes() +
+                np.asarray(datagram.angle, dtype='<i2').tobytes())
+    elif datagramtype == 'RAW3':
+        n = len(RAW3_LAYOUT.names)
+        body = pack_layout(RAW3_LAYOUT, datagram[1:n+1])
+        if datagram.power is not None:
+            body += np.asarray(datagram.power, dtype='<i2').tobytes()
+        if datagram.angle is not None:
+            body += np.asarray(datagram.angle, dtype='<i2').tobytes()
+        if datagram.samples is not None:
+            samples = np.asarray(datagram.samples, dtype='<c8')
+            if datagram.datatype & RAW3_COMPLEXFLOAT32:
+                body += samples.tobytes()
+            else:
+                body += samples.view('<f4').astype('<f2').tobytes()
+    else:
+        raise ValueError('Cannot pack {0} datagram'.format(datagramtype))
+
+    return dgheader + body
+
+
+def read_datagram_at(stream, offset, datagram_reader=read_datagram):
+    """Seeks to offset in stream, being the start of an encapsulated
+    datagram, and reads it.
+
+    """
+    stream.seek(offset)
+    return read_encapsulated_datagram(stream, datagram_reader)
+
+
+# Corrupted files are scanned for datagrams that can be recovered. A
+# datagram is taken to be valid when its type is known and its leading
+# and trailing length tags match. After a bad datagram the scanner
+# resynchronises on the next occurrence of a known type, found with
+# bytes.find, so damaged files are scanned at close to disk speed.
+
+DATAGRAM_TYPES = (b'CON0', b'RAW0', b'NME0', b'XML0', b'RAW3', b'MRU0',
+                  b'TAG0', b'FIL1')
+
+
+def valid_datagram_length(buffer, offset, datagramtypes=DATAGRAM_TYPES):
+    """Returns the length of the valid encapsulated datagram starting at
+    offset in buffer, or None if there is none.
+
+    """
+    n = len(buffer)
+    if offset < 0 or offset + 20 > n:
+        return None
+    length = struct.unpack_from('<i', buffer, offset)[0]
+    end = offset + 4 + length
+    if length < 12 or end + 4 > n:
+        return None
+    if bytes(buffer[offset + 4:offset + 8]) not in datagramtypes:
+        return None
+    if struct.unpack_from('<i', buffer, end)[0] != length:
+        return None
+    return length
+
+
+def scan_datagrams(buffer, datagramtypes=DATAGRAM_TYPES):
+    """Scans buffer, the content of a possibly corrupted RAW file such as
+    bytes or an mmap, for valid datagrams. Returns a list of the (offset,
+    length) of each valid encapsulated datagram and a list of the (start,
+    end) byte ranges lost between them.
+
+    """
+    n = len(buffer)
+    datagrams = []
+    lost = []
+
+    # Position of the next occurrence of each type not before the
+    # current search position, or n if there is none
+    following = dict.fromkeys(datagramtypes, -1)
+
+    offset = 0
+    while offset < n:
+        length = valid_datagram_length(buffer, offset, datagramtypes)
+        if length is not None:
+            datagrams.append((offset, length))
+            offset += length + 8
+            continue
+
+        # Resynchronise on the next type tag that starts a valid datagram
+        start = offset
+        position = offset + 5
+        offset = n
+        while True:
+            for t, p in following.items():
+                if p < position:
+                    p = buffer.find(t, position)
+                    following[t] = p if p >= 0 else n
+            p = min(following.values())
+            if p >= n:
+                break
+            if valid_datagram_length(buffer, p - 4, datagramtypes):
+                offset = p - 4
+                break
+            position = p + 1
+        lost.append((start, offset))
+
+    return datagrams, lost
+
+
+def scan_raw(filename, datagramtypes=DATAGRAM_TYPES):
+    """Scans the RAW file designated by filename as per scan_datagrams,
+    memory mapping it.
+
+    """
+    buffer = open_raw_mmap(filename).buffer
+    return scan_datagrams(buffer.obj if len(buffer) else b'', datagramtypes)
+
+
+# A datagram index records where each datagram lives in a RAW file
+# so that callers can seek straight to the datagrams they need. It is
+# built with one pass over the datagram headers and cached in a NumPy
+# sidecar file next to the RAW file, being invalidated when the size
+# or modification time of the RAW file changes.
+#
+# channel is the RAW0 channel number, or for RAW3 datagrams the one
+# based position of the channel identification in channelids. channel
+# is 0 and frequency NaN where not applicable.
+
+INDEX_DTYPE = np.dtype([('offset', '<i8'),
+                        ('length', '<i4'),
+                        ('datagramtype', 'S4'),
+                        ('filetime', '<u8'),
+                        ('channel', '<i2'),
+                        ('frequency', '<f4')])
+
+DatagramIndex = namedtuple('DatagramIndex', ['entries', 'channelids',
+                                             'size', 'mtime'])
+
+
+def index_filename(filename):
+    """Returns the name of the index sidecar file for the RAW file
+    designated by filename.
+
+    """
+    return filename + '.index.npz'
+
+
+def build_index(filename):
+    """Builds a DatagramIndex for the RAW file designated by filename by
+    reading just the datagram headers.
+
+    """
+    st = os.stat(filename)
+    buffer = open_raw_mmap(filename).buffer
+    n = len(buffer)
+
+    entries = []
+    channelids = []
+    offset = 0
+
+    while offset + 20 <= n:
+        length = struct.unpack_from('<i', buffer, offset)[0]
+        end = offset + 4 + length
+        if length < 12 or end + 4 > n:
+            break
+        if struct.unpack_from('<i', buffer, end)[0] != length:
+            raise ValueError('Invalid datagram')
+
+        datagramtype = bytes(buffer[offset + 4:offset + 8])
+        low, high = struct.unpack_from('<II', buffer, offset + 8)
+        channel = 0
+        frequency = math.nan
+
+        if datagramtype == b'RAW0' and length >= 24:
+            channel = struct.unpack_from('<h', buffer, offset + 16)[0]
+            frequency = struct.unpack_from('<f', buffer, offset + 24)[0]
+        elif datagramtype == b'RAW3' and length >= 140:
+            channelid = str(buffer[offset + 16:offset + 144],
+                            'utf-8').strip('\0')
+            if channelid not in channelids:
+                channelids.append(channelid)
+            channel = channelids.index(channelid) + 1
+
+        entries.append((offset, length, datagramtype,
+                        high * 4294967296 + low, channel, frequency))
+        offset = end + 4
+
+    return DatagramIndex(np.array(entries, dtype=INDEX_DTYPE),
+                         channelids, st.st_size, st.st_mtime_ns)
+
+
+def save_index(index, filename):
+    """Saves a DatagramIndex to the sidecar file of the RAW file
+    designated by filename.
+
+    """
+    sidecar = index_filename(filename)
+    temporary = sidecar + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, entries=index.entries,
+                 channelids=np.array(index.channelids, dtype=str),
+                 size=index.size, mtime=index.mtime)
+    os.replace(temporary, sidecar)
+
+
+def load_index(filename, cache=True):
+    """Returns a DatagramIndex for the RAW file designated by filename,
+    using the sidecar file if it is up to date and otherwise building
+    the index and, if cache is True, saving it.
+
+    Failure to write the sidecar (e.g. a read only survey disk) is not
+    an error.
+
+    """
+    st = os.stat(filename)
+    sidecar = index_filename(filename)
+
+    if cache and os.path.exists(sidecar):
+        try:
+            with np.load(sidecar) as z:
+                if (int(z['size']) == st.st_size
+                        and int(z['mtime']) == st.st_mtime_ns):
+                    return DatagramIndex(z['entries'],
+                                         list(z['channelids']),
+                                         st.st_size, st.st_mtime_ns)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    index = build_index(filename)
+
+    if cache:
+        try:
+            save_index(index, filename)
+        except OSError:
+            pass
+
+    return index
+
+
+def select_index(index, datagramtypes=None, channels=None,
+                 frequencies=None, start=None, end=None):
+    """Returns the entries of a DatagramIndex matching all the given
+    criteria, being collections of datagram types (e.g. 'RAW0'),
+    channel numbers and frequencies, and a filetime window.
+
+    """
+    entries = index.entries
+    mask = np.ones(len(entries), dtype=bool)
+
+    if datagramtypes is not None:
+        types = [t.encode() if isinstance(t, str) else t
+                 for t in datagramtypes]
+        mask &= np.isin(entries['datagramtype'], types)
+    if channels is not None:
+        mask &= np.isin(entries['channel'], list(channels))
+    if frequencies is not None:
+        mask &= np.isin(entries['frequency'], list(frequencies))
+    if start is not None:
+        mask &= entries['filetime'] >= start
+    if end is not None:
+        mask &= entries['filetime'] <= end
+
+    return entries[mask]
+
+
+# Simrad .idx files allow a ping to be found by time with a binary
+# search rather than a scan of the RAW file.
+
+PingIndex = namedtuple('PingIndex', ['filetimes', 'offsets', 'datagrams'])
+
+
+def idx_filename(filename):
+    """Returns the name of the Simrad .idx file that accompanies the RAW
+    file designated by filename.
+
+    """
+    return os.path.splitext(filename)[0] + '.idx'
+
+
+def load_idx(filename):
+    """Loads the IDX0 datagrams from the Simrad .idx file designated by
+    filename, returning a PingIndex of NumPy arrays of ping filetimes
+    and RAW file offsets, sorted by time.
+
+    """
+    datagrams = [d for d in load_raw(filename)
+                 if d.dgheader.datagramtype == 'IDX0']
+    datagrams.sort(key=datagram_filetime)
+
+    filetimes = np.array([datagram_filetime(d) for d in datagrams],
+                         dtype=np.uint64)
+    offsets = np.array([d.fileoffset for d in datagrams], dtype=np.int64)
+
+    return PingIndex(filetimes, offsets, datagrams)
+
+
+def idx_offset(pingindex, filetime):
+    """Returns the RAW file offset of the first ping at or after the
+    given filetime, or None if there is no such ping.
+
+    """
+    i = np.searchsorted(pingindex.filetimes, np.uint64(filetime),
+                        side='left')
+    if i >= len(pingindex.offsets):
+        return None
+    return int(pingindex.offsets[i])
+
+
+def seek_filetime(stream, pingindex, filetime):
+    """Seeks stream, being a RAW file, to the first ping at or after the
+    given filetime using pingindex, or to the end of the file if there
+    is no such ping. Returns the new position.
+
+    """
+    offset = idx_offset(pingindex, filetime)
+    if offset is None:
+        return stream.seek(0, 2)
+    return stream.seek(offset)
+
+
+# Lazy datagrams keep just the location of a datagram in a memory
+# mapped file and decode on first access, so that an index of every
+# datagram of a cruise can be held in memory cheaply.
+
+
+class LazyDatagram(object):
+    """A datagram of given length at offset in buffer (being the start of
+    the encapsulated datagram), decoded on first access.
+
+    dgheader, datagramtype and filetime decode just the header. Any
+    other attribute, e.g. frequency or xml, decodes the whole datagram
+    with datagram_reader and is delegated to it. Decoded values are
+    cached.
+
+    """
+
+    __slots__ = ('buffer', 'offset', 'length', 'datagram_reader',
+                 '_dgheader', '_datagram')
+
+    def __init__(self, buffer, offset, length,
+                 datagram_reader=read_datagram):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self.datagram_reader = datagram_reader
+        self._dgheader = None
+        self._datagram = None
+
+    @property
+    def dgheader(self):
+        if self._dgheader is None:
+            if self._datagram is not None:
+                self._dgheader = self._datagram.dgheader
+            else:
+                stream = BufferStream(self.buffer, self.offset + 4)
+                datagramtype = read_chars(stream, 4)
+                self._dgheader = DatagramHeader(datagramtype,
+                                                read_datetime(stream))
+        return self._dgheader
+
+    @property
+    def datagramtype(self):
+        return self.dgheader.datagramtype
+
+    @property
+    def filetime(self):
+        return filetime(self.dgheader.datetime)
+
+    @property
+    def datagram(self):
+        if self._datagram is None:
+            stream = BufferStream(self.buffer, self.offset + 4)
+            self._datagram = self.datagram_reader(stream, self.length)
+        return self._datagram
+
+    def __getattr__(self, name):
+        # Private and special names are never delegated, as they are
+        # looked up on instances whose slots are not yet set, e.g. by
+        # copy and pickle
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.datagram, name)
+
+    def __reduce__(self):
+        # Just the datagram's own bytes, not the whole mapped file
+        end = self.offset + self.length + 8
+        return (LazyDatagram, (bytes(self.buffer[self.offset:end]), 0,
+                               self.length, self.datagram_reader))
+
+    def __repr__(self):
+        return 'LazyDatagram({0}, offset={1}, length={2})'.format(
+            self.datagramtype, self.offset, self.length)
+
+
+def load_raw_lazy(filename, datagram_reader=read_datagram, cache=True):
+    """Returns a list of LazyDatagram, one for each datagram in the file
+    designated by filename, without decoding any of them.
+
+    The file is memory mapped and the datagrams located with
+    load_index, so cache determines whether the index sidecar file is
+    used.
+
+    """
+    buffer = open_raw_mmap(filename).buffer
+    entries = load_index(filename, cache).entries
+    return [LazyDatagram(buffer, offset, length, datagram_reader)
+            for offset, length in zip(entries['offset'].tolist(),
+                                      entries['length'].tolist())]
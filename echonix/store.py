@@ -0,0 +1,208 @@
+"""Stores echograms too large for memory on disk in chunks.
+
+A store is a directory of NumPy .npy files, each chunk holding up to
+chunksize pings as rows, together with the filetime, sample count and
+range in metres of each ping, and a store.json file describing the
+chunks. Chunks are memory mapped when read, so only the pings and
+samples asked for are loaded, however long the survey.
+
+As for echogram.egshow, samples are taken to be evenly spaced in range
+from 0 to the range of the longest ping.
+
+"""
+
+import os
+import json
+import numpy as np
+
+
+def chunk_filename(path, kind, i):
+    """Returns the name of the file holding the given kind of data (sv,
+    filetimes, counts or ranges) of chunk i of the store at path.
+
+    """
+    return os.path.join(path, '{0}-{1:05d}.npy'.format(kind, i))
+
+
+class SvStoreWriter(object):
+    """Appends pings of volume backscatter to the store at path, creating
+    it if necessary, holding at most one chunk of pings in memory.
+
+    """
+
+    def __init__(self, path, chunksize=1024, dtype=np.float32, attrs=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        metadata = os.path.join(path, 'store.json')
+        if os.path.exists(metadata):
+            with open(metadata) as f:
+                self.metadata = json.load(f)
+            if attrs:
+                self.metadata['attrs'].update(attrs)
+        else:
+            self.metadata = {'dtype': np.dtype(dtype).str,
+                             'chunksize': chunksize,
+                             'chunks': [],
+                             'attrs': attrs or {}}
+
+        self.chunksize = self.metadata['chunksize']
+        self.dtype = np.dtype(self.metadata['dtype'])
+        self.pings = np.full((self.chunksize, 0), np.nan, dtype=self.dtype)
+        self.filetimes = np.zeros(self.chunksize, dtype=np.uint64)
+        self.counts = np.zeros(self.chunksize, dtype=np.int64)
+        self.ranges = np.zeros(self.chunksize, dtype=np.float64)
+        self.n = 0
+
+    def append(self, ping, filetime, r):
+        """Appends ping, a 1D array of volume backscatter, recorded at
+        filetime with range r metres to its last sample.
+
+        """
+        m = len(ping)
+        if m > self.pings.shape[1]:
+            pings = np.full((self.chunksize, m), np.nan, dtype=self.dtype)
+            pings[:self.n, :self.pings.shape[1]] = self.pings[:self.n]
+            self.pings = pings
+
+        self.pings[self.n, :m] = ping
+        self.pings[self.n, m:] = np.nan
+        self.filetimes[self.n] = filetime
+        self.counts[self.n] = m
+        self.ranges[self.n] = r
+        self.n += 1
+
+        if self.n == self.chunksize:
+            self.flush()
+
+    def flush(self):
+        """Writes the pings appended so far as a new chunk.
+
+        """
+        if self.n == 0:
+            return
+
+        i = len(self.metadata['chunks'])
+        n = self.n
+        width = int(self.counts[:n].max())
+
+        np.save(chunk_filename(self.path, 'sv', i), self.pings[:n, :width])
+        np.save(chunk_filename(self.path, 'filetimes', i), self.filetimes[:n])
+        np.save(chunk_filename(self.path, 'counts', i), self.counts[:n])
+        np.save(chunk_filename(self.path, 'ranges', i), self.ranges[:n])
+
+        self.metadata['chunks'].append({'npings': n,
+                                        'nsamples': width,
+                                        'start': int(self.filetimes[0]),
+                                        'end': int(self.filetimes[n-1])})
+        self.write_metadata()
+        self.n = 0
+
+    def write_metadata(self):
+        metadata = os.path.join(self.path, 'store.json')
+        with open(metadata + '.tmp', 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(metadata + '.tmp', metadata)
+
+    def close(self):
+        self.flush()
+        self.write_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SvStore(object):
+    """Reads the store at path. The per ping filetimes, counts and ranges
+    are loaded, the volume backscatter only when sliced.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'store.json')) as f:
+            self.metadata = json.load(f)
+
+        chunks = self.metadata['chunks']
+        self.attrs = self.metadata['attrs']
+        self.dtype = np.dtype(self.metadata['dtype'])
+
+        def load(kind, dtype):
+            if not chunks:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate([np.load(chunk_filename(path, kind, i))
+                                   for i in range(len(chunks))])
+
+        self.filetimes = load('filetimes', np.uint64)
+        self.counts = load('counts', np.int64)
+        self.ranges = load('ranges', np.float64)
+        self.starts = np.cumsum([0] + [c['npings'] for c in chunks])
+        self.nsamples = max([c['nsamples'] for c in chunks], default=0)
+        self.range = float(self.ranges.max()) if len(self.ranges) else 0.0
+
+    def __len__(self):
+        return len(self.filetimes)
+
+    def chunk(self, i):
+        """Returns the volume backscatter of chunk i, memory mapped.
+
+        """
+        return np.load(chunk_filename(self.path, 'sv', i), mmap_mode='r')
+
+    def ping_slice(self, start=None, end=None):
+        """Returns the slice of pings between the start and end filetimes
+        inclusive.
+
+        """
+        i = 0 if start is None else int(np.searchsorted(
+            self.filetimes, np.uint64(start), side='left'))
+        j = len(self) if end is None else int(np.searchsorted(
+            self.filetimes, np.uint64(end), side='right'))
+        return slice(i, max(i, j))
+
+    def sample_slice(self, top=None, bottom=None):
+        """Returns the slice of samples between the top and bottom ranges
+        in metres inclusive.
+
+        """
+        n = self.nsamples
+        step = self.range / (n - 1) if n > 1 and self.range > 0 else 1.0
+        i = 0 if top is None else int(np.ceil(top / step))
+        j = n if bottom is None else int(np.floor(bottom / step)) + 1
+        return slice(max(0, i), max(0, min(n, j)))
+
+    def read(self, start=None, end=None, top=None, bottom=None):
+        """Returns the volume backscatter of the pings between the start
+        and end filetimes and of the samples between the top and bottom
+        ranges in metres, as a 2D array padded with NaN, together with
+        the filetimes of those pings and the (top, bottom) range in
+        metres. Only the chunks concerned are read.
+
+        """
+        pings = self.ping_slice(start, end)
+        samples = self.sample_slice(top, bottom)
+
+        sv = np.full((pings.stop - pings.start,
+                      samples.stop - samples.start), np.nan, dtype=self.dtype)
+
+        first = max(0, np.searchsorted(self.starts, pings.start,
+                                       side='right') - 1)
+        for i in range(first, len(self.starts) - 1):
+            a, b = self.starts[i], self.starts[i+1]
+            if a >= pings.stop:
+                break
+            lo, hi = max(a, pings.start), min(b, pings.stop)
+            if lo >= hi:
+                continue
+            chunk = self.chunk(i)
+            block = chunk[lo - a:hi - a, samples.start:samples.stop]
+            sv[lo - pings.start:hi - pings.start, :block.shape[1]] = block
+
+        n = self.nsamples
+        step = self.range / (n - 1) if n > 1 else 0.0
+        r = (samples.start * step, max(0, samples.stop - 1) * step)
+
+        return sv, self.filetimes[pings], r
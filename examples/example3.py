@@ -7,9 +7,13 @@ from echonix import ek60, echogram, imaging
 
 filename = r'../data/ek60/krill_swarm_20091215/JR230-D20091215-T121917.raw'
 
-Sv38, r = ek60.raw_to_sv(filename, 38000)
-Sv120, r = ek60.raw_to_sv(filename, 120000)
-Sv200, r = ek60.raw_to_sv(filename, 200000)
+# Read all three frequencies in a single pass over the file
+
+channels = ek60.raws_to_sv_channels([filename], [38000, 120000, 200000])
+
+Sv38, r = channels[38000]
+Sv120, r = channels[120000]
+Sv200, r = channels[200000]
 
 im = imaging.composite(Sv38, Sv120, Sv200, min = -95, max = -50)
 
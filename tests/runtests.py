@@ -48,3 +48,388 @@ echogram.show(m, range=r)
 
 datagrams = raw.load_raw('../data/ek80/EK80_Example_Data_01/EK80_SimradEcho_WC381_Sequential-D20150513-T090935.raw')
 assert len(datagrams) == 461
+
+# Test 5 - Seek by time using a Simrad .idx file
+
+pingindex = raw.load_idx('../data/ek60/jr16003/ek60-sample.idx')
+assert len(pingindex.offsets) == 273
+assert pingindex.datagrams[0].pingnumber == 1
+assert raw.idx_offset(pingindex, int(pingindex.filetimes[10])) == 961340
+assert raw.idx_offset(pingindex, int(pingindex.filetimes[-1]) + 1) is None
+
+# Test 6 - Vectorised SONAR equation matches the scalar version
+
+import numpy as np
+
+ranges = np.array([0, 1.5, 10.0, 250.0])
+sv = ek60.volume_backscatter_array(pr, f, G, phi, cv, t, alpha, pt, tau,
+                                   Sac, ranges)
+for x, y in zip(sv, ranges):
+    assert math.isclose(x, ek60.volume_backscatter(pr, f, G, phi, cv, t,
+                                                   alpha, pt, tau, Sac, y))
+
+# Test 7 - RAW3 datagrams with unknown datatype bits are skipped whole
+
+import io
+import warnings
+
+header = raw.DatagramHeader('RAW3', raw.read_datetime(io.BytesIO(bytes(8))))
+stream = io.BytesIO()
+raw.write_datagram(stream, b'RAW3' + bytes(8) +
+                   raw.pack_layout(raw.RAW3_LAYOUT, ('WBT', 0x1001, 0, 5)) +
+                   bytes(10))
+raw.write_datagram(stream, raw.pack_datagram(raw.SampleDatagram3(
+    header, 'WBT', raw.RAW3_POWER, 0, 3, None, np.arange(3, dtype=np.int16),
+    None)))
+stream.seek(0)
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    unknown = raw.read_encapsulated_datagram(stream)
+    known = raw.read_encapsulated_datagram(stream)
+assert unknown.datatype == 0x1001 and unknown.samples is None
+assert known.power.tolist() == [0, 1, 2]
+
+# Test 8 - Pulse compression matches direct correlation with the replica
+
+import os
+import shutil
+import struct
+import tempfile
+from echonix import ek80
+
+
+def filetime(t):
+    return raw.read_datetime(io.BytesIO(struct.pack('<Q', t)))
+
+
+wbt = 'WBT 1-1 ES38-7_ES'
+stages = [raw.FilterDatagram(raw.DatagramHeader('FIL1', filetime(1)), stage,
+                             wbt, n, decimation,
+                             (np.hanning(n) / np.sum(np.hanning(n)))
+                             .astype(np.complex64))
+          for stage, decimation, n in [(1, 6, 31), (2, 4, 15)]]
+fm = raw.Parameter(wbt, 0, 1, 34000, 44000, 0.001024, 0.1, 2.4e-05, 1000.0)
+
+rng = np.random.default_rng(0)
+samples = (rng.standard_normal((2, 200, 4)) +
+           1j * rng.standard_normal((2, 200, 4))).astype(np.complex64)
+samples[1, 180:] = np.nan
+compressed = ek80.pulse_compress(samples, fm, stages,
+                                 cache=ek80.ReplicaCache())
+replica = ek80.filter_signal(ek80.transmit_signal(fm), stages)
+for ping, n in [(0, 200), (1, 180)]:
+    for q in range(4):
+        y = np.convolve(samples[ping, :n, q], np.conj(replica[::-1]))
+        y = y[len(replica) - 1:][:n] / np.sum(np.abs(replica)**2)
+        assert np.allclose(compressed[ping, :n, q], y, atol=1e-5)
+assert np.all(np.isnan(compressed[1, 180:]))
+
+# Test 9 - EK80 Sv and TS of CW and FM pings match the SONAR equation
+
+configuration = (
+    '<Configuration><Header ApplicationName="EK80" Version="1.12"/>'
+    '<Transceivers><Transceiver Impedance="5400"><Channels>'
+    '<Channel ChannelID="{0}" PulseDuration="0.000512;0.001024;0.002048">'
+    '<Transducer Frequency="38000" EquivalentBeamAngle="-20.7" '
+    'Gain="26.5;26.6;26.7" SaCorrection="-0.3;-0.5;-0.7" '
+    'Impedance="60"/></Channel></Channels>'
+    '</Transceiver></Transceivers></Configuration>').format(wbt)
+environment = ('<Environment Depth="0" Acidity="8" Salinity="35" '
+               'SoundSpeed="1490" Temperature="10"/>')
+parameter = ('<Parameter><Channel ChannelID="{0}" PulseForm="{1}" '
+             'FrequencyStart="{2}" FrequencyEnd="{3}" '
+             'PulseDuration="0.001024" SampleInterval="2.4e-05" '
+             'TransmitPower="1000" Slope="0.1"/></Parameter>')
+cw = raw.Parameter(wbt, 0, 0, 38000, 38000, 0.001024, 0.1, 2.4e-05, 1000.0)
+assert raw.xml_element(configuration).find('.//Transceiver').get(
+    'Impedance') == '5400'
+assert raw.xml_element(configuration) is raw.xml_element(configuration)
+
+samples = samples[0]
+datagrams = [raw.XMLDatagram(raw.DatagramHeader('XML0', filetime(1)),
+                             configuration)] + stages + \
+    [raw.XMLDatagram(raw.DatagramHeader('XML0', filetime(2)), environment)]
+for t, p in [(10, cw), (20, fm)]:
+    datagrams.append(raw.XMLDatagram(
+        raw.DatagramHeader('XML0', filetime(t)),
+        parameter.format(wbt, p.pulseform, p.frequencystart,
+                         p.frequencyend)))
+    datagrams.append(raw.SampleDatagram3(
+        raw.DatagramHeader('RAW3', filetime(t)), wbt, raw.RAW3_COMPLEXFLOAT32 |
+        4 << 8, 0, 200, samples, None, None))
+
+filename = os.path.join(tempfile.mkdtemp(), 'ek80.raw')
+with open(filename, 'wb') as stream:
+    for datagram in datagrams:
+        raw.write_datagram(stream, raw.pack_datagram(datagram))
+sv, _ = ek80.raw_to_sv(filename, wbt)
+ts, _ = ek80.raw_to_sv(filename, wbt, ts=True)
+os.remove(filename)
+
+j = 100
+r = j * 1490 * 2.4e-05 / 2
+for ping, (p, y, sa) in enumerate([(cw, samples, -0.5),
+                                   (fm, compressed[0], 0)]):
+    power = np.abs(ek80.filter_signal(ek80.transmit_signal(p), stages))**2
+    tau = np.sum(power) / np.max(power) * 24 / 1.5e6
+    frequency = (p.frequencystart + p.frequencyend) / 2
+    prx = (4 * abs(np.mean(y[j]))**2 / 8 * ((5400 + 60) / 5400)**2 / 60)
+    alpha = ek80.francois_garrison(frequency, 1490, 10, 35, 0, 8)
+    wavelength = 1490 / frequency
+    common = 10 * math.log10(prx) + 2 * alpha * r - 2 * 26.6
+    psi = -20.7 + 20 * math.log10(38000 / frequency)
+    assert math.isclose(ts[ping, j], common + 40 * math.log10(r) -
+                        10 * math.log10(1000 * wavelength**2 /
+                                        (16 * math.pi**2)), abs_tol=1e-3)
+    assert math.isclose(sv[ping, j], common + 20 * math.log10(r) -
+                        10 * math.log10(1000 * wavelength**2 * 1490 /
+                                        (32 * math.pi**2)) -
+                        10 * math.log10(tau) - psi - 2 * sa, abs_tol=1e-3)
+assert np.all(np.isfinite(sv[:, 0]))
+
+# Test 10 - Datagram index of a synthetic EK60 file and its sidecar
+
+from echonix import cache, store
+
+
+def ek60_datagram(datagramtype, t, body):
+    return datagramtype + struct.pack('<Q', t) + body
+
+
+def write_ek60(filename, npings=6, t0=130000000000000000):
+    transducers = b''.join(raw.pack_layout(
+        raw.CONFIGURATION_TRANSDUCER_LAYOUT,
+        ('GPT {0} kHz'.format(frequency // 1000), 1, frequency, 25.92, -20.7,
+         7, 7, 21.9, 21.9, 0, 0, 0, 0, 0, 0, 0, 0,
+         (0.000256, 0.000512, 0.001024, 0.002048, 0.004096),
+         (25, 25.5, 25.92, 26, 26), (-0.5, -0.5, -0.49, -0.4, -0.4), '070413'))
+        for frequency in (38000, 120000))
+    rng = np.random.default_rng(1)
+    with open(filename, 'wb') as stream:
+        raw.write_datagram(stream, ek60_datagram(b'CON0', t0, raw.pack_layout(
+            raw.CONFIGURATION_HEADER_LAYOUT, ('Survey', 'T', 'ER60', '2.4',
+                                              2)) + transducers))
+        for p in range(npings):
+            t = t0 + p * 10000000
+            raw.write_datagram(stream, ek60_datagram(b'NME0', t, b'$GPGGA'))
+            for channel, frequency in [(1, 38000), (2, 120000)]:
+                count = 100 + 10 * channel + p % 2
+                raw.write_datagram(stream, ek60_datagram(
+                    b'RAW0', t + channel, raw.pack_layout(raw.RAW0_LAYOUT, (
+                        channel, 3, 5, frequency, 1000, 0.001024, 2425,
+                        0.000256, 1448.3, 0.0098, 0, 0, 0, 10, 0, 0, 0,
+                        count)) +
+                    rng.integers(-2000, 8000, count).astype('<i2').tobytes() +
+                    rng.integers(-32768, 32767, count).astype('<i2')
+                    .tobytes()))
+
+
+directory = tempfile.mkdtemp()
+filename = os.path.join(directory, 'ek60.raw')
+write_ek60(filename)
+index = raw.load_index(filename)
+assert os.path.exists(raw.index_filename(filename))
+assert len(raw.select_index(index, {'RAW0'}, frequencies=[38000])) == 6
+assert raw.load_index(filename).entries.tobytes() == index.entries.tobytes()
+write_ek60(filename, npings=4)
+assert len(raw.select_index(raw.load_index(filename), {'RAW0'})) == 8
+write_ek60(filename)
+os.utime(filename, ns=(0, index.mtime + 1))
+raw.load_index(filename)
+with np.load(raw.index_filename(filename)) as z:
+    assert int(z['size']) == index.size and int(z['mtime']) == index.mtime + 1
+
+# Test 11 - Reading in small blocks splits datagrams across blocks
+
+datagrams = list(raw.iter_datagrams(filename))
+assert len(datagrams) == 19
+for d, e in zip(datagrams, raw.iter_datagrams(filename, blocksize=37)):
+    assert raw.pack_datagram(d) == raw.pack_datagram(e)
+
+# Test 12 - Packed datagrams read back the same
+
+with open(filename, 'rb') as stream:
+    original = stream.read()
+packed = io.BytesIO()
+for d in datagrams:
+    raw.write_datagram(packed, raw.pack_datagram(d))
+assert packed.getvalue() == original
+
+# Test 13 - Ragged pings are padded with NaN
+
+pings = ek60.PingMatrix(npings=1)
+for ping in ([1.0, 2.0], [3.0], [4.0, 5.0, 6.0]):
+    pings.append(np.array(ping))
+data, counts = pings.result()
+assert counts.tolist() == [2, 1, 3]
+assert np.array_equal(data, [[1, 2, np.nan], [3, np.nan, np.nan], [4, 5, 6]],
+                      equal_nan=True)
+
+# Test 14 - Sv round trips through the on disk store and the cache
+
+sv, r, counts = ek60.raw_to_sv(filename, 38000, counts=True)
+assert sv.shape == (6, 111) and counts.tolist() == [110, 111] * 3
+assert np.isnan(sv[0, 110]) and not np.isnan(sv[1, 110])
+
+path = os.path.join(directory, 'store')
+assert ek60.raws_to_store([filename], 38000, path, chunksize=4,
+                          dtype=np.float64) == 6
+sv_store, filetimes, _ = store.SvStore(path).read()
+assert np.array_equal(sv_store, sv, equal_nan=True) and len(filetimes) == 6
+
+svcache = cache.SvCache(os.path.join(directory, 'cache'))
+cached = ek60.raws_to_sv([filename], 38000, counts=True, cache=svcache)
+again = ek60.raws_to_sv([filename], 38000, counts=True, cache=svcache)
+assert isinstance(again[0], np.memmap) and again[1] == r
+assert np.array_equal(again[0], sv, equal_nan=True)
+
+# Test 15 - Parallel decoding matches serial decoding
+
+later = os.path.join(directory, 'later.raw')
+write_ek60(later, t0=130000000100000000)
+parallel = ek60.raws_to_sv_parallel([filename, later], 38000, processes=2)
+assert np.array_equal(parallel[0], np.vstack([sv, sv]), equal_nan=True)
+parallel = ek60.raw_to_sv_parallel(filename, 38000, processes=3, counts=True)
+assert np.array_equal(parallel[0], sv, equal_nan=True)
+assert parallel[1] == r and parallel[2].tolist() == counts.tolist()
+
+# Test 16 - The scanner recovers the datagrams around damage
+
+sizes = [len(raw.pack_datagram(d)) + 8 for d in datagrams]
+damaged = bytearray(original)
+damaged[sum(sizes[:2]) + 4:sum(sizes[:2]) + 8] = b'XXXX'
+found, lost = raw.scan_datagrams(bytes(damaged))
+assert len(found) == 18 and lost == [(sum(sizes[:2]), sum(sizes[:3]))]
+
+# Test 17 - FIL1 datagrams are decoded
+
+stream = io.BytesIO()
+raw.write_datagram(stream, raw.pack_datagram(stages[0]))
+stream.seek(0)
+fil1 = raw.read_encapsulated_datagram(stream)
+assert (fil1.stage, fil1.channelid, fil1.decimationfactor) == (1, wbt, 6)
+assert np.array_equal(fil1.coefficients, stages[0].coefficients)
+
+# Test 18 - Calibration and replica caches can be shared between threads
+
+from concurrent.futures import ThreadPoolExecutor
+
+config = datagrams[0]
+pings = [d for d in datagrams if d.dgheader.datagramtype == 'RAW0']
+calibrations = ek60.CalibrationCache(maxsize=2)
+replicas = ek80.ReplicaCache(maxsize=2)
+
+
+def calibrate(i):
+    ping = pings[i % len(pings)]
+    sv, _ = ek60.datagram_volume_backscatter(ping, config, calibrations)
+    assert np.array_equal(sv, ek60.datagram_volume_backscatter(
+        ping, config, None)[0])
+    p = fm._replace(pulseduration=0.000256 * (1 + i % 4))
+    assert len(replicas.replica(p, stages)) == len(
+        ek80.filter_signal(ek80.transmit_signal(p), stages))
+
+
+with ThreadPoolExecutor(8) as executor:
+    list(executor.map(calibrate, range(400)))
+assert len(calibrations.calibrations) <= 2 and len(replicas.entries) <= 2
+
+# Test 19 - Datagrams received over UDP are written and calibrated
+
+import asyncio
+import socket
+from echonix import ingest
+
+
+async def loopback():
+    receiver = ingest.Ingest()
+    transport = await receiver.serve('127.0.0.1', 0)
+    address = transport.get_extra_info('sockname')
+    written = io.BytesIO()
+    echogram = ingest.RollingEchogram(6)
+    tasks = [asyncio.ensure_future(ingest.write_datagrams(receiver,
+                                                          written)),
+             asyncio.ensure_future(ingest.fill_echogram(receiver, echogram,
+                                                        38000))]
+    await asyncio.sleep(0)
+
+    # Every other datagram is sent bare, without its length tags
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        offset = 0
+        for i, size in enumerate(sizes):
+            packet = original[offset:offset + size]
+            sender.sendto(packet if i % 2 else packet[4:-4], address)
+            offset += size
+            await asyncio.sleep(0.001)
+
+    for _ in range(500):
+        if len(written.getvalue()) == len(original) and echogram.n == 6:
+            break
+        await asyncio.sleep(0.01)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    transport.close()
+    return receiver, written.getvalue(), echogram.result()
+
+
+receiver, received, (echo, filetimes, echo_range) = asyncio.run(loopback())
+assert receiver.received == 19 and receiver.errors == 0
+assert received == original
+assert np.array_equal(echo, sv, equal_nan=True) and echo_range == r
+
+# Test 20 - Following a file being written in odd sized pieces
+
+import threading
+import time
+
+
+def grow(filename, content, piece=97):
+    def write():
+        with open(filename, 'ab') as stream:
+            for i in range(0, len(content), piece):
+                stream.write(content[i:i + piece])
+                stream.flush()
+                time.sleep(0.002)
+    open(filename, 'wb').close()
+    writer = threading.Thread(target=write)
+    writer.start()
+    return writer
+
+
+growing = os.path.join(directory, 'growing.raw')
+writer = grow(growing, original)
+followed = list(ek60.follow_sv(growing, 38000, poll_interval=0.01,
+                               timeout=0.5))
+writer.join()
+assert len(followed) == 6 and max(x[2] for x in followed) == r
+for (_, ping, _), row, count in zip(followed, sv, counts):
+    assert np.array_equal(ping, row[:count])
+
+writer = grow(growing, original)
+followed = list(raw.follow_datagrams(growing, poll_interval=0.01,
+                                     timeout=0.5, blocksize=37))
+writer.join()
+assert [raw.pack_datagram(d) for d in followed] == \
+    [raw.pack_datagram(d) for d in datagrams]
+
+# Test 21 - Lazy datagrams decode, copy and pickle like datagrams
+
+import copy
+import pickle
+
+lazy = raw.load_raw_lazy(filename)
+loaded = raw.load_raw(filename)
+assert [d.datagramtype for d in lazy] == \
+    [d.dgheader.datagramtype for d in loaded]
+for d, e in zip(lazy, loaded):
+    if e.dgheader.datagramtype == 'RAW0':
+        assert d.frequency == e.frequency and d.filetime == \
+            raw.datagram_filetime(e)
+for d in (pickle.loads(pickle.dumps(lazy[3])), copy.copy(lazy[3])):
+    assert d.frequency == loaded[3].frequency
+    assert np.array_equal(d.power, loaded[3].power)
+# Private names are not delegated, even before the slots are set
+assert not hasattr(raw.LazyDatagram.__new__(raw.LazyDatagram), '_datagram')
+
+shutil.rmtree(directory)
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
 import sys
+from functools import partial
+import numpy as np
 from echonix import raw
-import xml.etree.ElementTree as ET
 
-# rawcat [FILE]
-# Concatenate raw files and print on the standard output
+# rawcat [FILE]...
+# Concatenate raw files and print on the standard output. With no
+# FILE, read standard input.
 
 # TODO: Clean up and consistency
 
@@ -29,8 +31,8 @@ def print_node(node, indent=0):
 
 
 def print_xml(x, indent=0):
-    tree = ET.fromstring(x)
-    print_node(tree, indent)
+    # The whole tree is printed, not just what raw.parse_xml models
+    print_node(raw.xml_element(x), indent)
 
 
 def print_named_tuple(x, indent=0):
@@ -46,6 +48,10 @@ def print_named_tuple(x, indent=0):
         elif type(value).__name__ == 'tuple':
             # unnamed tuple
             print_indented_String('{0}: {1}'.format(field, value), indent)
+        elif isinstance(value, np.ndarray):
+            # printed in full, as str would summarise a long array
+            print_indented_String('{0}: {1}'.format(field, value.tolist()),
+                                  indent)
         elif isinstance(value, tuple):
             # named tuple
             print_indented_String(field + ':', indent)
@@ -58,19 +64,20 @@ def cat_datagram(datagram):
     print_named_tuple(datagram)
 
 
-def cat_datagrams(filename):
-    with open(filename, "rb") as f:
-        while True:
-            datagram = raw.read_encapsulated_datagram(f, raw.read_datagram)
-            if not datagram:
-                break
-
-            cat_datagram(datagram)
+def cat_datagrams(source):
+    # RAW0 samples are read as tuples and lists, as printed before
+    # they were read into NumPy arrays
+    reader = partial(raw.read_datagram, compatible=True)
+    for datagram in raw.iter_datagrams(source, reader):
+        cat_datagram(datagram)
 
 
 def main():
-    for filename in sys.argv[1:]:
-        cat_datagrams(filename)
+    if len(sys.argv) > 1:
+        for filename in sys.argv[1:]:
+            cat_datagrams(filename)
+    else:
+        cat_datagrams(sys.stdin.buffer)
 
 
 if __name__ == "__main__":
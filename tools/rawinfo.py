@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import sys
-import xml.etree.ElementTree as ET
 from echonix import raw
 
 # rawinfo.py [FILE]...
@@ -18,10 +17,11 @@ def info(filename):
 
         dt = raw.datagram_python_datetime(datagram)
         if datagram.dgheader.datagramtype == 'XML0':
-            header = ET.fromstring(datagram.xml).find('Header')
-            x = header.attrib['ApplicationName']
-            print("type: {}".format(x))
+            configuration = raw.datagram_xml(datagram)
+            print("type: {}".format(configuration.applicationname))
             print('datetime: {}'.format(dt))
+            for x in configuration.channels:
+                print('transducer: {0}'.format(x.channelid))
         else:
             print("type: {}".format(datagram.configurationheader.soundername))
             print("surveyname: {}".format(
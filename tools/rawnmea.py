@@ -8,12 +8,8 @@ from echonix import raw
 
 def nmea_sentences(filename):
     with open(filename, "rb") as f:
-        while True:
-            datagram = raw.read_encapsulated_datagram(f, raw.read_datagram)
-            if not datagram:
-                break
-            if datagram.dgheader.datagramtype == 'NME0':
-                print(datagram.text)
+        for datagram in raw.iter_selected_datagrams(f, {'NME0'}):
+            print(datagram.text)
 
 
 def main():
@@ -1,27 +1,32 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 from echonix import raw
 
-# rawrepair [FILE]
-# Attempt to recover datagrams from the start of a corrupted RAW file
-# writing good datagrams to a new file repaired.raw
-
-# TODO: Attempt to recover from corrupted packets by searching for
-# common datagram headers.
-
-# TODO: BUG don't keet overwriting repaired.raw
+# rawrepair [FILE]...
+# Recover the valid datagrams of corrupted RAW files, writing them to
+# a new file named after each, e.g. D20160101-T000000-repaired.raw,
+# and report the byte ranges that were lost.
 
 
 def repair(filename):
-    with open(filename, "rb") as f:
-        with open('repaired.raw', "wb") as w:
-            while True:
-                print(f.tell())
-                datagram = raw.read_encapsulated_datagram(f, raw.read_bytes)
-                if not datagram:
-                    break
-                raw.write_datagram(w, datagram)
+    base, ext = os.path.splitext(filename)
+    output = base + '-repaired' + ext
+
+    buffer = raw.open_raw_mmap(filename).buffer
+    datagrams, lost = raw.scan_raw(filename)
+
+    with open(output, "wb") as w:
+        for offset, length in datagrams:
+            w.write(buffer[offset:offset + length + 8])
+
+    for start, end in lost:
+        print('{0}: lost bytes {1}-{2} ({3} bytes)'.format(
+            filename, start, end, end - start))
+    print('{0}: recovered {1} datagrams to {2}, lost {3} bytes'.format(
+        filename, len(datagrams), output,
+        sum(end - start for start, end in lost)))
 
 
 def main():